@@ -1,4 +1,4 @@
-import sys, pygame, time, math
+import sys, os, io, re, hashlib, sqlite3, threading, pygame, time, math, random, array, bisect, collections, concurrent.futures
 from pygame.locals import *
 
 """
@@ -20,6 +20,1779 @@ from pygame.locals import *
 		TOTAL  27 HRS
 """
 
+#----------------------------------------------------------
+# BPChartWriter class
+#----------------------------------------------------------
+class BPChartWriter(object):
+	"""
+		Streams notes out to a chart in both the text and
+		binary formats. Notes are buffered and appended to
+		session files next to the chart in batches, so a
+		recording session is on disk as it goes instead of
+		only at the end. The chart itself is only replaced
+		by commit(), so an unfinished session never costs
+		the old chart.
+
+		Text format: one note per line, "down\tup\tkey"
+		Binary format: BINARY_MAGIC followed by little-endian
+		float64 (down, up, key) triples, one per note.
+	"""
+	textFile = None
+	binaryFile = None
+	batchSize = 0
+	pending = []
+
+	BINARY_MAGIC = b'BPC1'		# Binary chart header
+	BINARY_TYPECODE = 'd'		# array typecode for binary chart values
+	SESSION_SUFFIX = '.session'	# Appended to the chart paths for the files being written
+
+	def __init__(self, textFile, binaryFile, batchSize = 32):
+		"""
+			init() method
+
+			Starts both session files. Notes are written out
+			every batchSize notes and on flush().
+		"""
+		self.textFile = textFile
+		self.binaryFile = binaryFile
+		self.batchSize = batchSize
+		self.pending = []
+		with open(self.textFile + self.SESSION_SUFFIX, 'w'): pass
+		with open(self.binaryFile + self.SESSION_SUFFIX, 'wb') as f:
+			f.write(self.BINARY_MAGIC)
+
+	def append(self, down, up, key):
+		"""
+			Buffers a note. Notes must be appended in order
+			of their down time.
+		"""
+		self.pending.append((down, up, key))
+		if len(self.pending) >= self.batchSize:
+			self.flush()
+
+	def flush(self):
+		"""
+			Appends all buffered notes to both session files.
+		"""
+		if len(self.pending) == 0: return
+
+		with open(self.textFile + self.SESSION_SUFFIX, 'a') as f:
+			f.write(''.join(['%f\t%f\t%d\n' % note for note in self.pending]))
+
+		values = array.array(self.BINARY_TYPECODE)
+		for note in self.pending: values.extend(note)
+		if sys.byteorder == 'big': values.byteswap()
+		with open(self.binaryFile + self.SESSION_SUFFIX, 'ab') as f:
+			f.write(values.tobytes())
+		self.pending = []
+
+	def commit(self):
+		"""
+			Flushes and moves the session files over the
+			chart files.
+		"""
+		self.flush()
+		os.replace(self.textFile + self.SESSION_SUFFIX, self.textFile)
+		os.replace(self.binaryFile + self.SESSION_SUFFIX, self.binaryFile)
+
+#----------------------------------------------------------
+# BPChartAnalyzer class
+#----------------------------------------------------------
+class BPChartAnalyzer(object):
+	"""
+		Difficulty analysis of a chart. A few linear sweeps
+		over the sorted down times and columns measure:
+		
+		- density: average notes per second, the peak and
+		  the 90th percentile over sliding NPS_WINDOWs
+		- jacks: notes within JACK_TIME of the previous note
+		  in the same column, per column
+		- streams: runs of at least STREAM_MIN_NOTES steps
+		  each within STREAM_TIME of the last (a chord is
+		  one step)
+		- chords: steps with notes in more than one column
+		
+		and combine them into one difficulty rating. The
+		values are kept as a flat array (see toArray) so
+		they can be stored with a compiled chart.
+	"""
+	notesPerSecond = 0.0
+	peakNotesPerSecond = 0.0
+	sustainedNotesPerSecond = 0.0
+	jacks = []
+	streamNotes = 0
+	longestStream = 0
+	chords = 0
+	difficulty = 0.0
+	
+	NUM_COLUMNS = 4
+	NPS_WINDOW = 1.0				# Window (seconds) for notes per second
+	SUSTAINED_PERCENTILE = 0.9		# Window density reported as sustained
+	CHORD_TIME = 0.02				# Notes this close together are one step
+	JACK_TIME = 0.25				# Same column repeats this close are jacks
+	STREAM_TIME = 0.2				# Steps this close together continue a stream
+	STREAM_MIN_NOTES = 8			# Shortest run counted as a stream
+	STREAM_WEIGHT = 0.5				# Density bonus for a chart made entirely of streams
+	TECHNICAL_WEIGHT = 2.0			# Rating per jack or chord per second
+	NUM_VALUES = 7 + NUM_COLUMNS	# Length of toArray()
+	
+	def __init__(self):
+		self.notesPerSecond = 0.0
+		self.peakNotesPerSecond = 0.0
+		self.sustainedNotesPerSecond = 0.0
+		self.jacks = [0] * self.NUM_COLUMNS
+		self.streamNotes = 0
+		self.longestStream = 0
+		self.chords = 0
+		self.difficulty = 0.0
+		
+	def analyze(self, downs, keys, duration):
+		"""
+			downs and keys are the notes' down times and
+			columns, sorted by down time. duration is the
+			song's length in seconds.
+		"""
+		self.__init__()
+		n = len(downs)
+		if n == 0 or duration <= 0: return self
+		
+		# Notes per second over sliding windows (two pointers)
+		counts = array.array('i', [0] * n)
+		first = 0
+		for last in range(n):
+			while downs[last] - downs[first] >= self.NPS_WINDOW: first = first + 1
+			counts[last] = last - first + 1
+		self.notesPerSecond = float(n) / duration
+		self.peakNotesPerSecond = max(counts) / self.NPS_WINDOW
+		self.sustainedNotesPerSecond = sorted(counts)[int((n - 1) * self.SUSTAINED_PERCENTILE)] / self.NPS_WINDOW
+		
+		# Jacks per column
+		lastDown = [None] * self.NUM_COLUMNS
+		for i in range(n):
+			key = keys[i]
+			if lastDown[key] != None and downs[i] - lastDown[key] <= self.JACK_TIME:
+				self.jacks[key] = self.jacks[key] + 1
+			lastDown[key] = downs[i]
+			
+		# Steps (chords count once) and the streams they form
+		run = 0
+		runNotes = 0
+		stepStart = None
+		i = 0
+		while i < n:
+			j = i + 1
+			while j < n and downs[j] - downs[i] <= self.CHORD_TIME: j = j + 1
+			if len(set(keys[i:j])) > 1: self.chords = self.chords + 1
+			
+			if stepStart != None and downs[i] - stepStart <= self.STREAM_TIME:
+				run = run + 1
+				runNotes = runNotes + (j - i)
+			else:
+				self.addStream(run, runNotes)
+				run = 1
+				runNotes = j - i
+			stepStart = downs[i]
+			i = j
+		self.addStream(run, runNotes)
+		
+		density = (self.notesPerSecond + self.sustainedNotesPerSecond + self.peakNotesPerSecond) / 3.0
+		technical = (sum(self.jacks) + self.chords) / duration
+		streamFraction = float(self.streamNotes) / n
+		self.difficulty = round((density * (1 + (self.STREAM_WEIGHT * streamFraction))) + (self.TECHNICAL_WEIGHT * technical), 2)
+		return self
+		
+	def addStream(self, steps, notes):
+		if steps < self.STREAM_MIN_NOTES: return
+		self.streamNotes = self.streamNotes + notes
+		self.longestStream = max(self.longestStream, notes)
+		
+	def toArray(self):
+		return array.array('d', [
+			self.notesPerSecond, self.peakNotesPerSecond, self.sustainedNotesPerSecond,
+			self.streamNotes, self.longestStream, self.chords, self.difficulty] + self.jacks)
+			
+	def fromArray(self, values):
+		self.notesPerSecond, self.peakNotesPerSecond, self.sustainedNotesPerSecond = values[0], values[1], values[2]
+		self.streamNotes, self.longestStream, self.chords = int(values[3]), int(values[4]), int(values[5])
+		self.difficulty = values[6]
+		self.jacks = [int(value) for value in values[7:7 + self.NUM_COLUMNS]]
+		return self
+	
+#----------------------------------------------------------
+# BPCompiledChart class
+#----------------------------------------------------------
+class BPCompiledChart(object):
+	"""
+		A level's chart and beats in the form gameplay uses
+		them, as written by BPChartCompiler: flat arrays of
+		note down and up times and columns, each note's spawn
+		time, and the beat times.
+		
+		Spawn times are only good for the pixelsPerSecond and
+		spawnDistance they were compiled with. The chart's
+		BPChartAnalyzer results are stored alongside, so the
+		song index doesn't have to analyze it again.
+		
+		File format: MAGIC, the 40 character hex sha1 of the
+		source files, then little-endian arrays: a float64
+		header (note count, beat count, pixelsPerSecond,
+		spawnDistance), float64 downs, ups, spawns and beats,
+		int32 columns and the float64 analysis (see
+		BPChartAnalyzer.toArray).
+	"""
+	sourceHash = None
+	pixelsPerSecond = 0.0
+	spawnDistance = 0.0
+	downs = None
+	ups = None
+	keys = None
+	spawns = None
+	beats = None
+	analysis = None
+	
+	MAGIC = b'BPX3'
+	HASH_LENGTH = 40
+	NUM_COLUMNS = 4
+	
+	def __init__(self):
+		self.sourceHash = None
+		self.pixelsPerSecond = 0.0
+		self.spawnDistance = 0.0
+		self.downs = array.array('d')
+		self.ups = array.array('d')
+		self.keys = array.array('i')
+		self.spawns = array.array('d')
+		self.beats = array.array('d')
+		self.analysis = BPChartAnalyzer()
+		
+	def getNotes(self):
+		return list(zip(self.downs, self.ups, self.keys))
+		
+	def toBytes(self):
+		header = array.array('d', [len(self.downs), len(self.beats), self.pixelsPerSecond, self.spawnDistance])
+		arrays = [header, self.downs, self.ups, self.spawns, self.beats, self.keys, self.analysis.toArray()]
+		data = [self.MAGIC, self.sourceHash.encode('ascii')]
+		for values in arrays:
+			if sys.byteorder == 'big':
+				values = array.array(values.typecode, values)
+				values.byteswap()
+			data.append(values.tobytes())
+		return b''.join(data)
+		
+	def fromBytes(self, data):
+		"""
+			Reads a compiled chart. Returns False if data
+			isn't one.
+		"""
+		if data[:len(self.MAGIC)] != self.MAGIC: return False
+		
+		offset = len(self.MAGIC)
+		self.sourceHash = data[offset:offset + self.HASH_LENGTH].decode('ascii')
+		offset = offset + self.HASH_LENGTH
+		
+		def take(typecode, count):
+			values = array.array(typecode)
+			end = offset + (count * values.itemsize)
+			values.frombytes(data[offset:end])
+			if sys.byteorder == 'big': values.byteswap()
+			return values, end
+			
+		header, offset = take('d', 4)
+		numNotes, numBeats = int(header[0]), int(header[1])
+		self.pixelsPerSecond, self.spawnDistance = header[2], header[3]
+		self.downs, offset = take('d', numNotes)
+		self.ups, offset = take('d', numNotes)
+		self.spawns, offset = take('d', numNotes)
+		self.beats, offset = take('d', numBeats)
+		self.keys, offset = take('i', numNotes)
+		values, offset = take('d', BPChartAnalyzer.NUM_VALUES)
+		self.analysis = BPChartAnalyzer().fromArray(values)
+		return True
+	
+#----------------------------------------------------------
+# BPChartCompiler class
+#----------------------------------------------------------
+class BPChartCompiler(object):
+	"""
+		Checks a level's timing_N.txt and beats_N.txt and
+		compiles them into a BPCompiledChart (timing_N.bpc).
+		Works straight from the files in songsDir, without
+		the song index, so levels can be compiled in
+		separate processes.
+		
+		Notes and beats are normalized first: sorted, with
+		exact duplicates dropped. What normalizing fixes is
+		reported as a warning, anything else as an error.
+		Charts with errors aren't compiled. A compiled chart
+		is skipped when the sha1 of its sources and its
+		compile settings haven't changed.
+	"""
+	songsDir = None
+	pixelsPerSecond = 0.0
+	spawnDistance = 0.0
+	
+	NUM_COLUMNS = BPCompiledChart.NUM_COLUMNS
+	
+	STATUS_COMPILED = 'compiled'
+	STATUS_CACHED = 'cached'
+	STATUS_INVALID = 'invalid'
+	
+	def __init__(self, songsDir, pixelsPerSecond, spawnDistance):
+		self.songsDir = songsDir
+		self.pixelsPerSecond = pixelsPerSecond
+		self.spawnDistance = spawnDistance
+		
+	def getPath(self, pattern, level):
+		return os.path.join(self.songsDir, pattern % level)
+		
+	def readSource(self, pattern, level):
+		path = self.getPath(pattern, level)
+		if not os.path.exists(path): return None
+		with open(path, 'rb') as f:
+			return f.read()
+		
+	def getSourceHash(self, sources):
+		digest = hashlib.sha1()
+		for data in sources:
+			digest.update(b'-' if data == None else (b'%d:' % len(data)) + data)
+		return digest.hexdigest()
+		
+	def parseNotes(self, text, errors):
+		"""
+			Returns ((down, up, key), line number) pairs in file
+			order. Lines that don't parse are reported and
+			skipped.
+		"""
+		notes = []
+		for lineNo, line in enumerate(text.splitlines(), 1):
+			if line.strip() == '': continue
+			try:
+				values = line.split('\t')
+				note = (float(values[0]), float(values[1]), int(float(values[2])))
+			except (ValueError, IndexError):
+				errors.append('timing line %d: expected "down<TAB>up<TAB>key", got %r' % (lineNo, line))
+				continue
+			notes.append((note, lineNo))
+		return notes
+		
+	def parseBeats(self, text, errors):
+		beats = []
+		for lineNo, line in enumerate(text.splitlines(), 1):
+			if line.strip() == '': continue
+			try:
+				beats.append((float(line.split('\t')[0]), lineNo))
+			except ValueError:
+				errors.append('beats line %d: expected a time, got %r' % (lineNo, line))
+		return beats
+		
+	def checkNotes(self, notes, errors, warnings):
+		"""
+			Validates notes in file order and returns them
+			normalized.
+		"""
+		for i in range(len(notes)):
+			(down, up, key), lineNo = notes[i]
+			if key < 0 or key >= self.NUM_COLUMNS:
+				errors.append('timing line %d: column %d is not in 0-%d' % (lineNo, key, self.NUM_COLUMNS - 1))
+			if up < down:
+				errors.append('timing line %d: up time %f is before down time %f' % (lineNo, up, down))
+			if i > 0 and down < notes[i - 1][0][0]:
+				warnings.append('timing line %d: notes are not sorted by down time' % lineNo)
+				
+		normalized = sorted(notes, key = lambda note: (note[0][0], note[0][2], note[0][1], note[1]))
+		unique = []
+		for note in normalized:
+			if len(unique) > 0 and unique[-1][0] == note[0]:
+				warnings.append('timing line %d: duplicate of line %d' % (note[1], unique[-1][1]))
+				continue
+			unique.append(note)
+			
+		# A column can't have a note start before its last one is released
+		lastInColumn = {}
+		for (down, up, key), lineNo in unique:
+			if key in lastInColumn and down < lastInColumn[key][0][1]:
+				errors.append('timing line %d: overlaps the hold on line %d in column %d' % (lineNo, lastInColumn[key][1], key))
+			lastInColumn[key] = ((down, up, key), lineNo)
+		return [note for note, lineNo in unique]
+		
+	def checkBeats(self, beats, errors, warnings):
+		if len(beats) == 0:
+			errors.append('beats: no beats')
+			return []
+		for i in range(1, len(beats)):
+			if beats[i][0] < beats[i - 1][0]:
+				warnings.append('beats line %d: beats are not sorted' % beats[i][1])
+		normalized = sorted(set([beat for beat, lineNo in beats]))
+		if len(normalized) < len(beats):
+			warnings.append('beats: %d duplicate beats' % (len(beats) - len(normalized)))
+		return normalized
+		
+	def compile(self, level, force = False):
+		"""
+			Validates and compiles a level. Returns (status,
+			errors, warnings), status being one of the
+			STATUS_* values.
+		"""
+		errors = []
+		warnings = []
+		timingData = self.readSource(BPSongLibrary.TIMING_FILE, level)
+		beatData = self.readSource(BPSongLibrary.BEAT_FILE, level)
+		speedData = self.readSource(BPSongLibrary.SPEED_FILE, level)
+		sourceHash = self.getSourceHash((timingData, beatData, speedData))
+		
+		outPath = self.getPath(BPSongLibrary.COMPILED_FILE, level)
+		if force == False and os.path.exists(outPath):
+			cached = BPCompiledChart()
+			with open(outPath, 'rb') as f:
+				if cached.fromBytes(f.read()) and cached.sourceHash == sourceHash and \
+					cached.pixelsPerSecond == self.pixelsPerSecond and cached.spawnDistance == self.spawnDistance:
+					return (self.STATUS_CACHED, errors, warnings)
+		
+		if timingData == None: errors.append('timing: missing %s' % self.getPath(BPSongLibrary.TIMING_FILE, level))
+		if beatData == None: errors.append('beats: missing %s' % self.getPath(BPSongLibrary.BEAT_FILE, level))
+		if len(errors) > 0: return (self.STATUS_INVALID, errors, warnings)
+		
+		notes = self.checkNotes(self.parseNotes(timingData.decode('ascii'), errors), errors, warnings)
+		beats = self.checkBeats(self.parseBeats(beatData.decode('ascii'), errors), errors, warnings)
+		changes = []
+		if speedData != None:
+			for lineNo, line in enumerate(speedData.decode('ascii').splitlines(), 1):
+				if line.strip() == '': continue
+				try:
+					values = line.split('\t')
+					changes.append((float(values[0]), float(values[1])))
+				except (ValueError, IndexError):
+					errors.append('speeds line %d: expected "time<TAB>multiplier", got %r' % (lineNo, line))
+		try:
+			noteField = BPNoteField(self.pixelsPerSecond, 1.0, changes)
+		except ValueError as e:
+			errors.append('speeds: %s' % e)
+		if len(errors) > 0: return (self.STATUS_INVALID, errors, warnings)
+		
+		chart = BPCompiledChart()
+		chart.sourceHash = sourceHash
+		chart.pixelsPerSecond = self.pixelsPerSecond
+		chart.spawnDistance = self.spawnDistance
+		chart.beats = array.array('d', beats)
+		for i in range(len(notes)):
+			down, up, key = notes[i]
+			chart.downs.append(down)
+			chart.ups.append(up)
+			chart.keys.append(key)
+			chart.spawns.append(noteField.getTime(noteField.getDistance(down) - self.spawnDistance))
+		duration = max([up for down, up, key in notes] + beats + [0.0])
+		chart.analysis.analyze(chart.downs, chart.keys, duration)
+		
+		tempPath = outPath + '.tmp'	# Never leave a half written chart behind
+		with open(tempPath, 'wb') as f:
+			f.write(chart.toBytes())
+		os.replace(tempPath, outPath)
+		return (self.STATUS_COMPILED, errors, warnings)
+		
+	def writeNormalized(self, level):
+		"""
+			Rewrites a level's timing and beat files sorted and
+			without duplicates. Returns False if they have
+			errors normalizing can't fix.
+		"""
+		errors = []
+		timingData = self.readSource(BPSongLibrary.TIMING_FILE, level)
+		beatData = self.readSource(BPSongLibrary.BEAT_FILE, level)
+		if timingData == None or beatData == None: return False
+		notes = self.checkNotes(self.parseNotes(timingData.decode('ascii'), errors), errors, [])
+		self.parseBeats(beatData.decode('ascii'), errors)
+		if len(errors) > 0: return False
+		
+		with open(self.getPath(BPSongLibrary.TIMING_FILE, level), 'w') as f:
+			f.write(''.join(['%f\t%f\t%d\n' % note for note in notes]))
+			
+		# Beat lines keep their other columns
+		lines = [line for line in beatData.decode('ascii').splitlines() if line.strip() != '']
+		lines.sort(key = lambda line: float(line.split('\t')[0]))
+		unique = []
+		for line in lines:
+			if len(unique) > 0 and float(unique[-1].split('\t')[0]) == float(line.split('\t')[0]): continue
+			unique.append(line)
+		with open(self.getPath(BPSongLibrary.BEAT_FILE, level), 'w') as f:
+			f.write(''.join([line + '\n' for line in unique]))
+		return True
+	
+#----------------------------------------------------------
+# BPSongLibrary class
+#----------------------------------------------------------
+class BPSongLibrary(object):
+	"""
+		Catalogue of the songs on disk. A song is the set of
+		timing_N.txt, beats_N.txt, bg_N.png and song_N.ogg
+		files sharing the level number N; a level exists
+		once its beat file does.
+		
+		Song metadata lives in an SQLite index, one row per
+		level, with the mtime and size of the files each row
+		was built from. At boot only songs whose files have
+		changed are re-read, and menus sort and filter with
+		querySongs() without opening any charts. Charts,
+		beats, backgrounds and audio are only loaded on
+		selection.
+	"""
+	songsDir = None
+	db = None
+	songs = {}
+	
+	INDEX_FILE = 'songs.db'			# SQLite index, relative to the songs dir
+	INDEX_VERSION = 4				# Bump when the columns change to force a rebuild
+	TIMING_FILE = 'timing_%d.txt'	# Text chart
+	BINARY_FILE = 'timing_%d.bin'	# Binary chart (see BPChartWriter)
+	COMPILED_FILE = 'timing_%d.bpc'	# Compiled chart and beats (see BPChartCompiler)
+	BEAT_FILE = 'beats_%d.txt'		# Beat timings
+	BG_FILE = 'bg_%d.png'			# Background image
+	SONG_FILE = 'song_%d.ogg'		# Audio
+	TITLE_FILE = 'title_%d.txt'		# Optional, first line is the song title
+	SPEED_FILE = 'speeds_%d.txt'	# Optional scroll speed changes (see loadSpeedChanges)
+	BEAT_FILE_PATTERN = re.compile(r'^beats_(\d+)\.txt$')
+	
+	SONG_KEY_LEVEL = 'level'		# Dictionary key
+	SONG_KEY_TITLE = 'title'		# Dictionary key
+	SONG_KEY_BPM = 'bpm'			# Dictionary key
+	SONG_KEY_LENGTH = 'length'		# Dictionary key (seconds to the last note up)
+	SONG_KEY_DURATION = 'duration'	# Dictionary key (seconds to the last note or beat)
+	SONG_KEY_NOTES = 'notes'		# Dictionary key (note count)
+	SONG_KEY_PEAK_NPS = 'peak_nps'	# Dictionary key (most notes per second in any window)
+	SONG_KEY_JACKS = 'jacks'		# Dictionary key (jacks in all columns)
+	SONG_KEY_CHORDS = 'chords'		# Dictionary key (steps with more than one note)
+	SONG_KEY_STREAM_NOTES = 'stream_notes'	# Dictionary key (notes in streams)
+	SONG_KEY_DIFFICULTY = 'difficulty'		# Dictionary key (see BPChartAnalyzer)
+	SONG_KEY_HASH = 'hash'			# Dictionary key (sha1 of the text chart)
+	SONG_KEY_TIMING_FILE = 'timing_file'	# Dictionary key
+	SONG_KEY_BINARY_FILE = 'binary_file'	# Dictionary key
+	SONG_KEY_COMPILED_FILE = 'compiled_file'	# Dictionary key
+	SONG_KEY_BEAT_FILE = 'beat_file'		# Dictionary key
+	SONG_KEY_BG_FILE = 'bg_file'			# Dictionary key
+	SONG_KEY_SONG_FILE = 'song_file'		# Dictionary key
+	SONG_KEY_SPEED_FILE = 'speed_file'		# Dictionary key
+	SONG_KEY_STAMP = 'stamp'		# Dictionary key (mtimes and sizes of the source files)
+	
+	# Index columns, named after the dictionary keys
+	SONG_COLUMNS = (
+		(SONG_KEY_LEVEL, 'INTEGER PRIMARY KEY'),
+		(SONG_KEY_TITLE, 'TEXT'),
+		(SONG_KEY_BPM, 'REAL'),
+		(SONG_KEY_LENGTH, 'REAL'),
+		(SONG_KEY_DURATION, 'REAL'),
+		(SONG_KEY_NOTES, 'INTEGER'),
+		(SONG_KEY_PEAK_NPS, 'REAL'),
+		(SONG_KEY_JACKS, 'INTEGER'),
+		(SONG_KEY_CHORDS, 'INTEGER'),
+		(SONG_KEY_STREAM_NOTES, 'INTEGER'),
+		(SONG_KEY_DIFFICULTY, 'REAL'),
+		(SONG_KEY_HASH, 'TEXT'),
+		(SONG_KEY_TIMING_FILE, 'TEXT'),
+		(SONG_KEY_BINARY_FILE, 'TEXT'),
+		(SONG_KEY_COMPILED_FILE, 'TEXT'),
+		(SONG_KEY_BEAT_FILE, 'TEXT'),
+		(SONG_KEY_BG_FILE, 'TEXT'),
+		(SONG_KEY_SONG_FILE, 'TEXT'),
+		(SONG_KEY_SPEED_FILE, 'TEXT'),
+		(SONG_KEY_STAMP, 'TEXT'))
+	
+	def __init__(self, songsDir):
+		self.songsDir = songsDir
+		self.db = None
+		self.songs = {}
+		
+	def load(self):
+		"""
+			Opens the index and brings it up to date with the
+			songs directory.
+		"""
+		self.db = sqlite3.connect(os.path.join(self.songsDir, self.INDEX_FILE))
+		if self.db.execute('PRAGMA user_version').fetchone()[0] != self.INDEX_VERSION:
+			self.db.execute('DROP TABLE IF EXISTS songs')
+			self.db.execute('PRAGMA user_version = %d' % self.INDEX_VERSION)
+		self.db.execute('CREATE TABLE IF NOT EXISTS songs (%s)' % 
+			', '.join(['%s %s' % column for column in self.SONG_COLUMNS]))
+		
+		names = [column[0] for column in self.SONG_COLUMNS]
+		self.songs = {}
+		for row in self.db.execute('SELECT %s FROM songs' % ', '.join(names)):
+			song = dict(zip(names, row))
+			self.songs[song[self.SONG_KEY_LEVEL]] = song
+		self.refresh()
+		
+	def refresh(self):
+		"""
+			Re-reads only the songs whose files changed size
+			or mtime since they were indexed, and drops songs
+			that are gone. A level needs its beats and its audio.
+			Levels whose files can't be read are left out and
+			reported, and tried again on the next refresh.
+			Returns the number of rows changed.
+		"""
+		levels = set()
+		for name in os.listdir(self.songsDir):
+			match = self.BEAT_FILE_PATTERN.match(name)
+			if match != None and os.path.exists(os.path.join(self.songsDir, self.SONG_FILE % int(match.group(1)))):
+				levels.add(int(match.group(1)))
+			
+		changed = 0
+		for level in list(self.songs.keys()):
+			if level not in levels:
+				del self.songs[level]
+				self.db.execute('DELETE FROM songs WHERE level = ?', (level,))
+				changed = changed + 1
+		for level in levels:
+			stamp = self.getStamp(level)
+			if level in self.songs and self.songs[level][self.SONG_KEY_STAMP] == stamp: continue
+			try:
+				song = self.describeSong(level)
+			except (ValueError, UnicodeDecodeError, IOError, OSError) as e:
+				print('level %d: skipped, %s' % (level, e))
+				if level in self.songs:
+					del self.songs[level]
+					self.db.execute('DELETE FROM songs WHERE level = ?', (level,))
+					changed = changed + 1
+				continue
+			song[self.SONG_KEY_STAMP] = stamp
+			self.songs[level] = song
+			names = [column[0] for column in self.SONG_COLUMNS]
+			self.db.execute('INSERT OR REPLACE INTO songs (%s) VALUES (%s)' % (', '.join(names), ', '.join(['?'] * len(names))),
+				[song[name] for name in names])
+			changed = changed + 1
+		self.db.commit()
+		return changed
+		
+	def scan(self):
+		"""
+			Rebuilds the whole index from the songs directory.
+		"""
+		self.songs = {}
+		self.db.execute('DELETE FROM songs')
+		self.refresh()
+		
+	def getStamp(self, level):
+		"""
+			Size and mtime of every file a level's index row is
+			derived from, as one comparable string.
+		"""
+		stamps = []
+		for pattern in (self.TIMING_FILE, self.BEAT_FILE, self.TITLE_FILE):
+			path = os.path.join(self.songsDir, pattern % level)
+			if os.path.exists(path):
+				info = os.stat(path)
+				stamps.append('%d:%d' % (info.st_size, int(info.st_mtime * 1000000)))
+			else:
+				stamps.append('-')
+		return '/'.join(stamps)
+		
+	def describeSong(self, level):
+		"""
+			Builds the index entry for a level from its chart
+			and beat files.
+		"""
+		song = {
+			self.SONG_KEY_LEVEL:level,
+			self.SONG_KEY_TITLE:'Level %d' % level,
+			self.SONG_KEY_TIMING_FILE:os.path.join(self.songsDir, self.TIMING_FILE % level),
+			self.SONG_KEY_BINARY_FILE:os.path.join(self.songsDir, self.BINARY_FILE % level),
+			self.SONG_KEY_COMPILED_FILE:os.path.join(self.songsDir, self.COMPILED_FILE % level),
+			self.SONG_KEY_BEAT_FILE:os.path.join(self.songsDir, self.BEAT_FILE % level),
+			self.SONG_KEY_BG_FILE:os.path.join(self.songsDir, self.BG_FILE % level),
+			self.SONG_KEY_SONG_FILE:os.path.join(self.songsDir, self.SONG_FILE % level),
+			self.SONG_KEY_SPEED_FILE:os.path.join(self.songsDir, self.SPEED_FILE % level)
+		}
+		
+		titlePath = os.path.join(self.songsDir, self.TITLE_FILE % level)
+		if os.path.exists(titlePath):
+			with open(titlePath, 'r') as f:
+				song[self.SONG_KEY_TITLE] = f.readline().strip()
+		
+		# Chart summary
+		chart = []
+		digest = hashlib.sha1()
+		if os.path.exists(song[self.SONG_KEY_TIMING_FILE]):
+			with open(song[self.SONG_KEY_TIMING_FILE], 'rb') as f:
+				data = f.read()
+			digest.update(data)
+			chart = self.parseTextChart(data.decode('ascii'))
+		beats = self.loadBeats(level, song)
+		song[self.SONG_KEY_HASH] = digest.hexdigest()
+		song[self.SONG_KEY_NOTES] = len(chart)
+		song[self.SONG_KEY_LENGTH] = max([note[1] for note in chart] + [0.0])
+		song[self.SONG_KEY_DURATION] = max(beats + [song[self.SONG_KEY_LENGTH]])
+		
+		# Difficulty, from the compiled chart if it's up to date
+		compiled = self.loadCompiledChart(level, song)
+		if compiled != None:
+			analysis = compiled.analysis
+		else:
+			chart.sort()
+			analysis = BPChartAnalyzer().analyze([note[0] for note in chart], [note[2] for note in chart], song[self.SONG_KEY_DURATION])
+		song[self.SONG_KEY_PEAK_NPS] = analysis.peakNotesPerSecond
+		song[self.SONG_KEY_JACKS] = sum(analysis.jacks)
+		song[self.SONG_KEY_CHORDS] = analysis.chords
+		song[self.SONG_KEY_STREAM_NOTES] = analysis.streamNotes
+		song[self.SONG_KEY_DIFFICULTY] = analysis.difficulty
+		
+		# Tempo from the median beat interval
+		intervals = sorted([beats[i + 1] - beats[i] for i in range(len(beats) - 1)])
+		song[self.SONG_KEY_BPM] = 0.0
+		if len(intervals) > 0 and intervals[len(intervals) // 2] > 0:
+			song[self.SONG_KEY_BPM] = 60.0 / intervals[len(intervals) // 2]
+		return song
+		
+	def getLevels(self):
+		return sorted(self.songs.keys())
+		
+	def getSong(self, level):
+		return self.songs[level]
+		
+	def querySongs(self, orderBy = SONG_KEY_LEVEL, descending = False, minDifficulty = None, maxDifficulty = None):
+		"""
+			Returns the levels sorted by any index column and
+			optionally filtered by difficulty, straight from
+			the index.
+		"""
+		if orderBy not in [column[0] for column in self.SONG_COLUMNS]:
+			raise ValueError('Unknown song column: %s' % orderBy)
+			
+		query = 'SELECT level FROM songs WHERE 1'
+		params = []
+		if minDifficulty != None:
+			query = query + ' AND difficulty >= ?'
+			params.append(minDifficulty)
+		if maxDifficulty != None:
+			query = query + ' AND difficulty <= ?'
+			params.append(maxDifficulty)
+		query = query + ' ORDER BY %s %s, level' % (orderBy, 'DESC' if descending else 'ASC')
+		return [row[0] for row in self.db.execute(query, params)]
+		
+	def parseTextChart(self, text):
+		chart = []
+		for line in text.splitlines():
+			if line.strip() == '': continue
+			timingValues = [float(i) for i in line.split('\t')]
+			chart.append((timingValues[0], timingValues[1], int(timingValues[2])))
+		return chart
+		
+	def parseBinaryChart(self, data):
+		values = array.array(BPChartWriter.BINARY_TYPECODE)
+		values.frombytes(data[len(BPChartWriter.BINARY_MAGIC):])
+		if sys.byteorder == 'big': values.byteswap()
+		return [(values[i], values[i + 1], int(values[i + 2])) for i in range(0, len(values) - 2, 3)]
+		
+	def loadChart(self, level):
+		"""
+			Returns the level's notes as (down, up, key) tuples.
+			The binary chart is used when it is at least as new
+			as the text chart.
+		"""
+		song = self.songs[level]
+		timingPath = song[self.SONG_KEY_TIMING_FILE]
+		binaryPath = song[self.SONG_KEY_BINARY_FILE]
+		
+		if os.path.exists(binaryPath) and (not os.path.exists(timingPath) or 
+			os.path.getmtime(binaryPath) >= os.path.getmtime(timingPath)):
+			with open(binaryPath, 'rb') as f:
+				data = f.read()
+			if data[:len(BPChartWriter.BINARY_MAGIC)] == BPChartWriter.BINARY_MAGIC:
+				return self.parseBinaryChart(data)
+				
+		if not os.path.exists(timingPath): return []
+		with open(timingPath, 'r') as f:
+			return self.parseTextChart(f.read())
+		
+	def loadCompiledChart(self, level, song = None):
+		"""
+			Returns the level's BPCompiledChart, or None if it
+			hasn't been compiled since its chart, beat or
+			speed files last changed.
+		"""
+		if song == None: song = self.songs[level]
+		compiledPath = song[self.SONG_KEY_COMPILED_FILE]
+		if not os.path.exists(compiledPath): return None
+		
+		compiledTime = os.path.getmtime(compiledPath)
+		for key in (self.SONG_KEY_TIMING_FILE, self.SONG_KEY_BEAT_FILE, self.SONG_KEY_SPEED_FILE):
+			if os.path.exists(song[key]) and os.path.getmtime(song[key]) > compiledTime: return None
+			
+		chart = BPCompiledChart()
+		with open(compiledPath, 'rb') as f:
+			if chart.fromBytes(f.read()) == False: return None
+		return chart
+		
+	def loadBeats(self, level, song = None):
+		if song == None: song = self.songs[level]
+		beats = []
+		with open(song[self.SONG_KEY_BEAT_FILE], 'r') as f:
+			for line in f:
+				if line.strip() == '': continue
+				beats.append(float(line.split('\t')[0]))
+		return beats
+		
+	def loadSpeedChanges(self, level):
+		"""
+			Returns the level's scroll speed changes as (time,
+			multiplier) pairs, one tab separated pair per line
+			of its speeds file. A BPM change is written as the
+			new BPM over the song's BPM. Levels without a
+			speeds file scroll at a constant speed.
+		"""
+		path = self.songs[level][self.SONG_KEY_SPEED_FILE]
+		changes = []
+		if not os.path.exists(path): return changes
+		with open(path, 'r') as f:
+			for line in f:
+				if line.strip() == '': continue
+				values = line.split('\t')
+				changes.append((float(values[0]), float(values[1])))
+		return changes
+	
+#----------------------------------------------------------
+# BPScaler class
+#----------------------------------------------------------
+class BPScaler(object):
+	"""
+		Maps the game's layout onto the real window. Layout
+		is done in LAYOUT_SIZE pixels, which the scaler
+		normalizes and maps onto the window with one uniform
+		scale, centred (letterboxed) if the aspect differs.
+		
+		Images are scaled once per resolution with smoothscale
+		and cached on disk, keyed by the source file's hash
+		and the target scale, so later launches at the same
+		resolution just load the cached copies.
+	"""
+	windowSize = None
+	cacheDir = None
+	scale = 1.0
+	origin = (0, 0)
+	
+	LAYOUT_SIZE = (960, 540)		# Size of the layout space (native asset resolution)
+	
+	def __init__(self, windowSize, cacheDir):
+		self.windowSize = windowSize
+		self.cacheDir = cacheDir
+		self.scale = min(
+			float(windowSize[0]) / float(self.LAYOUT_SIZE[0]),
+			float(windowSize[1]) / float(self.LAYOUT_SIZE[1]))
+		self.origin = (
+			(windowSize[0] - (self.LAYOUT_SIZE[0] * self.scale)) / 2.0,
+			(windowSize[1] - (self.LAYOUT_SIZE[1] * self.scale)) / 2.0)
+		
+	def toScreen(self, pos):
+		"""
+			Layout position to window position.
+		"""
+		return (self.origin[0] + (pos[0] * self.scale), self.origin[1] + (pos[1] * self.scale))
+		
+	def toScreenLength(self, length):
+		return int(round(length * self.scale))
+		
+	def load(self, path, size = None):
+		"""
+			Loads an image scaled for the window, or to size if
+			given (e.g. the window size for backgrounds). The
+			result is not converted, so this is safe to call off
+			the main thread.
+		"""
+		if size == None and self.scale == 1.0: return pygame.image.load(path)
+		
+		with open(path, 'rb') as f:
+			data = f.read()
+		scaleKey = 's%d' % int(round(self.scale * 1000))
+		if size != None: scaleKey = '%dx%d' % size
+		cachePath = os.path.join(self.cacheDir, '%s_%s.png' % (hashlib.sha1(data).hexdigest(), scaleKey))
+		if os.path.exists(cachePath): return pygame.image.load(cachePath)
+		
+		img = pygame.image.load(io.BytesIO(data), path)
+		if img.get_bitsize() < 24: img = img.convert_alpha()	# smoothscale needs 24 or 32 bits
+		if size == None:
+			size = (max(self.toScreenLength(img.get_width()), 1), max(self.toScreenLength(img.get_height()), 1))
+		img = pygame.transform.smoothscale(img, size)
+		try:
+			if not os.path.isdir(self.cacheDir): os.makedirs(self.cacheDir)
+			pygame.image.save(img, cachePath)
+		except (pygame.error, IOError, OSError):
+			pass	# Still usable, just not cached
+		return img
+	
+#----------------------------------------------------------
+# BPPreviewLoader class
+#----------------------------------------------------------
+class BPPreviewLoader(object):
+	"""
+		Loads song previews and backgrounds on a background
+		thread. The owner says which levels it wants, in
+		priority order, and polls for results; stale requests
+		are simply dropped from the wanted list.
+		
+		A preview is a PREVIEW_LENGTH clip of the song audio
+		starting at PREVIEW_OFFSET of the way in. The whole
+		song is decoded on the worker thread, then only the
+		clip is kept. Both caches hold at most cacheSize
+		entries, evicting unwanted levels before wanted ones
+		and then least recently used first, so memory stays
+		bounded however many songs the library has.
+	"""
+	library = None
+	scaler = None
+	cacheSize = 0
+	wanted = []
+	previews = None
+	backgrounds = None
+	condition = None
+	thread = None
+	running = False
+	
+	PREVIEW_LENGTH = 10.0		# Preview clip length (seconds)
+	PREVIEW_OFFSET = 0.3		# Preview start, as a fraction of the song duration
+	
+	def __init__(self, library, scaler, cacheSize = 5):
+		self.library = library
+		self.scaler = scaler
+		self.cacheSize = cacheSize
+		self.wanted = []
+		self.previews = collections.OrderedDict()
+		self.backgrounds = collections.OrderedDict()
+		self.condition = threading.Condition()
+		self.thread = None
+		self.running = False
+		
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		
+	def want(self, levels):
+		"""
+			Replaces the levels to load, most wanted first.
+		"""
+		with self.condition:
+			self.wanted = list(levels)[:self.cacheSize]
+			self.condition.notify()
+			
+	def getCached(self, cache, level):
+		with self.condition:
+			if level not in cache: return None
+			cache[level] = cache.pop(level)		# Most recently used
+			return cache[level]
+			
+	def getPreview(self, level):
+		return self.getCached(self.previews, level)
+		
+	def getBackground(self, level):
+		return self.getCached(self.backgrounds, level)
+		
+	def getNextLevel(self):
+		for level in self.wanted:
+			if level not in self.previews or level not in self.backgrounds: return level
+		return None
+		
+	def loadPreview(self, level):
+		song = self.library.getSong(level)
+		sound = pygame.mixer.Sound(song[self.library.SONG_KEY_SONG_FILE])
+		frequency, size, channels = pygame.mixer.get_init()
+		frameBytes = channels * abs(size) // 8
+		offset = int(song[self.library.SONG_KEY_DURATION] * self.PREVIEW_OFFSET * frequency) * frameBytes
+		length = int(self.PREVIEW_LENGTH * frequency) * frameBytes
+		raw = memoryview(sound).cast('B')		# The samples in place, get_raw() would copy the whole song
+		offset = min(offset, max(len(raw) - length, 0) // frameBytes * frameBytes)
+		return pygame.mixer.Sound(buffer = raw[offset:offset + length])
+		
+	def run(self):
+		while True:
+			with self.condition:
+				while self.running and self.getNextLevel() == None:
+					self.condition.wait()
+				if not self.running: return
+				level = self.getNextLevel()
+				
+			# Decode outside the lock. Missing or broken files
+			# are cached as None so they aren't retried.
+			preview = None
+			background = None
+			try:
+				preview = self.loadPreview(level)
+			except (pygame.error, IOError, OSError):
+				pass
+			try:
+				background = self.scaler.load(self.library.getSong(level)[self.library.SONG_KEY_BG_FILE], self.scaler.windowSize)
+			except (pygame.error, IOError, OSError):
+				pass
+				
+			with self.condition:
+				self.previews[level] = preview
+				self.backgrounds[level] = background
+				for cache in (self.previews, self.backgrounds): self.evict(cache)
+				
+	def evict(self, cache):
+		"""
+			Shrinks a cache to cacheSize, dropping the least
+			recently used levels that are no longer wanted
+			first, so scrolling doesn't throw out (and decode
+			again) a level that is still wanted.
+		"""
+		for level in [level for level in cache if level not in self.wanted]:
+			if len(cache) <= self.cacheSize: return
+			del cache[level]
+		while len(cache) > self.cacheSize: cache.popitem(False)
+	
+#----------------------------------------------------------
+# BPLeaderboard class
+#----------------------------------------------------------
+class BPLeaderboard(object):
+	"""
+		Local high scores, one SQLite row per play, keyed by
+		the chart's hash (SONG_KEY_HASH) so an edited chart
+		starts a fresh board.
+		
+		All database work happens on a worker thread, which
+		owns the connection. addResult() only queues the row;
+		rows are written in one transaction once BATCH_SIZE
+		are waiting or the oldest has waited BATCH_DELAY, so
+		saving never stalls a frame. Lookups return a
+		concurrent.futures.Future to poll from the game loop.
+		Queued rows are written before any lookup is answered,
+		so a lookup always sees the results added before it.
+		
+		Top scores and personal bests are read straight off
+		the (hash, score) and (hash, player, score) indexes,
+		so they stay fast however many rows there are.
+	"""
+	path = None
+	pending = []
+	firstPending = 0.0
+	lookups = []
+	condition = None
+	thread = None
+	running = False
+	
+	BATCH_SIZE = 64					# Queued rows that trigger a write
+	BATCH_DELAY = 2.0				# Longest a queued row waits (seconds)
+	
+	RESULT_KEY_HASH = 'song_hash'	# Dictionary key (sha1 of the text chart)
+	RESULT_KEY_LEVEL = 'level'		# Dictionary key
+	RESULT_KEY_PLAYER = 'player'	# Dictionary key
+	RESULT_KEY_SCORE = 'score'		# Dictionary key
+	RESULT_KEY_MAX_COMBO = 'max_combo'	# Dictionary key
+	RESULT_KEY_PERFECT = 'perfect'	# Dictionary key (hits in the first tier)
+	RESULT_KEY_GREAT = 'great'		# Dictionary key (hits in the second tier)
+	RESULT_KEY_GOOD = 'good'		# Dictionary key (hits in the third tier)
+	RESULT_KEY_MISS = 'miss'		# Dictionary key
+	RESULT_KEY_DROP = 'dropped'	# Dictionary key (holds let go early)
+	RESULT_KEY_MEAN_OFFSET = 'mean_offset'	# Dictionary key (seconds, late is positive)
+	RESULT_KEY_PLAYED = 'played'	# Dictionary key (time.time() of the play)
+	
+	# Table columns, named after the dictionary keys
+	RESULT_COLUMNS = (
+		(RESULT_KEY_HASH, 'TEXT NOT NULL'),
+		(RESULT_KEY_LEVEL, 'INTEGER'),
+		(RESULT_KEY_PLAYER, 'TEXT NOT NULL'),
+		(RESULT_KEY_SCORE, 'INTEGER NOT NULL'),
+		(RESULT_KEY_MAX_COMBO, 'INTEGER'),
+		(RESULT_KEY_PERFECT, 'INTEGER'),
+		(RESULT_KEY_GREAT, 'INTEGER'),
+		(RESULT_KEY_GOOD, 'INTEGER'),
+		(RESULT_KEY_MISS, 'INTEGER'),
+		(RESULT_KEY_DROP, 'INTEGER'),
+		(RESULT_KEY_MEAN_OFFSET, 'REAL'),
+		(RESULT_KEY_PLAYED, 'REAL'))
+	TIER_KEYS = (RESULT_KEY_PERFECT, RESULT_KEY_GREAT, RESULT_KEY_GOOD)
+	
+	def __init__(self, path):
+		self.path = path
+		self.pending = []
+		self.firstPending = 0.0
+		self.lookups = []
+		self.condition = threading.Condition()
+		self.thread = None
+		self.running = False
+		
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		
+	def stop(self):
+		"""
+			Writes whatever is queued and stops the worker.
+		"""
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		if self.thread != None: self.thread.join()
+		
+	def addResult(self, result):
+		"""
+			Queues a result, a dictionary of RESULT_KEY_*
+			values.
+		"""
+		names = [column[0] for column in self.RESULT_COLUMNS]
+		with self.condition:
+			if len(self.pending) == 0: self.firstPending = time.time()
+			self.pending.append([result[name] for name in names])
+			if len(self.pending) >= self.BATCH_SIZE: self.condition.notify()
+			
+	def lookup(self, query, params, single = False):
+		"""
+			Queues a query. Returns a Future of its rows as
+			dictionaries, or of the first row (None if there
+			isn't one) if single is True.
+		"""
+		future = concurrent.futures.Future()
+		with self.condition:
+			self.lookups.append((future, query, params, single))
+			self.condition.notify()
+		return future
+		
+	def getTopScores(self, songHash, count):
+		"""
+			Future of the song's best count results, highest
+			first (earliest first on a tie).
+		"""
+		return self.lookup('SELECT %s FROM scores WHERE song_hash = ? ORDER BY score DESC, id LIMIT ?' %
+			', '.join([column[0] for column in self.RESULT_COLUMNS]), (songHash, count))
+			
+	def getPersonalBest(self, songHash, player):
+		"""
+			Future of the player's best result on the song, or
+			None if they haven't played it.
+		"""
+		return self.lookup('SELECT %s FROM scores WHERE song_hash = ? AND player = ? ORDER BY score DESC, id LIMIT 1' %
+			', '.join([column[0] for column in self.RESULT_COLUMNS]), (songHash, player), True)
+		
+	def open(self):
+		db = sqlite3.connect(self.path)
+		db.execute('PRAGMA journal_mode = WAL')		# Readers don't wait on the batch writes
+		db.execute('PRAGMA synchronous = NORMAL')
+		db.execute('CREATE TABLE IF NOT EXISTS scores (id INTEGER PRIMARY KEY, %s)' %
+			', '.join(['%s %s' % column for column in self.RESULT_COLUMNS]))
+		db.execute('CREATE INDEX IF NOT EXISTS scores_by_song ON scores (song_hash, score DESC)')
+		db.execute('CREATE INDEX IF NOT EXISTS scores_by_player ON scores (song_hash, player, score DESC)')
+		db.commit()
+		return db
+		
+	def isWriteDue(self):
+		if len(self.pending) == 0: return False
+		return len(self.pending) >= self.BATCH_SIZE or time.time() - self.firstPending >= self.BATCH_DELAY
+		
+	def run(self):
+		db = self.open()
+		names = [column[0] for column in self.RESULT_COLUMNS]
+		while True:
+			with self.condition:
+				while self.running and len(self.lookups) == 0 and not self.isWriteDue():
+					timeout = None
+					if len(self.pending) > 0: timeout = self.firstPending + self.BATCH_DELAY - time.time()
+					self.condition.wait(timeout)
+				rows, self.pending = self.pending, []
+				lookups, self.lookups = self.lookups, []
+				running = self.running
+				
+			if len(rows) > 0:
+				with db:
+					db.executemany('INSERT INTO scores (%s) VALUES (%s)' % (', '.join(names), ', '.join(['?'] * len(names))), rows)
+			for future, query, params, single in lookups:
+				if not future.set_running_or_notify_cancel(): continue
+				try:
+					results = [dict(zip(names, row)) for row in db.execute(query, params)]
+				except sqlite3.Error as e:
+					future.set_exception(e)
+					continue
+				if single: future.set_result(results[0] if len(results) > 0 else None)
+				else: future.set_result(results)
+			if not running:
+				db.close()
+				return
+	
+#----------------------------------------------------------
+# BPDisplay class
+#----------------------------------------------------------
+class BPDisplay(object):
+	"""
+		Owns the window and frame pacing. By default frames are
+		paced by sleeping until just before the deadline and
+		busy-waiting the last SPIN_TIME, which is far steadier
+		than sleep alone, and input is polled all through the
+		wait. With vsync requested, and where SDL2 allows it,
+		the window is opened double buffered with vsync on the
+		renderer/texture path (SCALED) and presenting blocks
+		until the flip; input is then only polled once a frame,
+		which costs judgement precision (see BPInputCapture).
+		
+		presentLatency is a running average of how long a
+		present takes, for the timing code to compensate.
+	"""
+	windowSize = None
+	period = 0.0
+	vsyncRequested = False
+	vsync = False
+	surface = None
+	nextFrame = 0.0
+	lastFrame = 0.0
+	frameInterval = 0.0
+	presentLatency = 0.0
+	
+	SPIN_TIME = 0.002				# Busy-wait the last 2 ms before a frame deadline
+	POLL_TIME = 0.001				# Interval between poll calls while waiting
+	LATENCY_SMOOTHING = 0.1			# Weight of the newest sample in the running averages
+	VSYNC_MIN_INTERVAL = 0.75		# Fraction of the frame period vsync must hold frames to
+	
+	def __init__(self, windowSize, fps, vsync = False):
+		self.windowSize = windowSize
+		self.period = 1.0 / float(fps)
+		self.vsyncRequested = vsync
+		self.vsync = False
+		self.surface = None
+		self.nextFrame = 0.0
+		self.lastFrame = 0.0
+		self.frameInterval = self.period
+		self.presentLatency = 0.0
+		
+	def open(self):
+		"""
+			Opens the window, falling back to a plain software
+			window if vsync is not available. Returns the
+			display surface.
+		"""
+		if self.vsyncRequested == True:
+			try:
+				self.surface = pygame.display.set_mode(self.windowSize, SCALED | DOUBLEBUF, vsync = 1)
+				self.vsync = True
+			except (pygame.error, TypeError, NameError):
+				self.surface = None		# Older pygame/SDL, or no vsync on this driver
+		if self.surface == None:
+			self.surface = pygame.display.set_mode(self.windowSize)
+			self.vsync = False
+		self.lastFrame = time.perf_counter()
+		self.nextFrame = self.lastFrame + self.period
+		return self.surface
+		
+	def present(self, rects = None):
+		"""
+			Shows the frame. Only rects are updated, if given,
+			unless the whole buffer is flipped under vsync.
+		"""
+		start = time.perf_counter()
+		if self.vsync == True or rects == None:
+			pygame.display.flip()
+		else:
+			pygame.display.update(rects)
+		elapsed = time.perf_counter() - start
+		self.presentLatency = self.presentLatency + (self.LATENCY_SMOOTHING * (elapsed - self.presentLatency))
+		
+	def waitForNextFrame(self, poll = None):
+		"""
+			Frame limiter. poll is called about every POLL_TIME
+			while waiting, so the wait can be spent sampling
+			input. Under vsync present() already waits for the
+			display and poll is called just once a frame; that
+			holds for as long as vsync is seen to hold frames
+			back, since some drivers accept the flag and ignore
+			it.
+		"""
+		now = time.perf_counter()
+		if self.vsync == True:
+			self.frameInterval = self.frameInterval + (self.LATENCY_SMOOTHING * ((now - self.lastFrame) - self.frameInterval))
+			self.lastFrame = now
+			if self.frameInterval >= self.period * self.VSYNC_MIN_INTERVAL:
+				if poll != None: poll()
+				return
+			self.vsync = False
+			self.nextFrame = now + self.period
+			
+		if now > self.nextFrame + self.period:
+			self.nextFrame = now	# Fell behind, don't try to catch up
+		while now < self.nextFrame:
+			if poll != None: poll()
+			now = time.perf_counter()
+			if self.nextFrame - now > self.SPIN_TIME:
+				time.sleep(min(self.POLL_TIME, self.nextFrame - now - self.SPIN_TIME))
+				now = time.perf_counter()
+		self.nextFrame = self.nextFrame + self.period
+	
+#----------------------------------------------------------
+# BPInputCapture class
+#----------------------------------------------------------
+class BPInputCapture(object):
+	"""
+		Pumps SDL events and stamps each with an estimate of
+		when it happened, in time.time() seconds, as the
+		EVENT_TIME attribute. SDL doesn't give us the OS
+		timestamp, but every event in a pump arrived since the
+		previous pump, so the midpoint of that interval is an
+		unbiased estimate, off by at most half the time between
+		pumps (capped at MAX_WINDOW). On the frame limiter path
+		that is about half a millisecond; pumped once a frame
+		under vsync it is up to about 8 ms. Handlers judge
+		against the stamp instead of the time they happen to
+		run.
+	"""
+	lastPump = None
+	
+	EVENT_TIME = 'timeCaptured'		# Event attribute holding the capture time
+	MAX_WINDOW = 1.0 / 60.0			# Longest interval (seconds) trusted for the estimate
+	
+	def __init__(self):
+		self.lastPump = None
+		
+	def capture(self):
+		"""
+			Returns the pending events, stamped.
+		"""
+		now = time.time()
+		events = pygame.event.get()
+		window = 0.0
+		if self.lastPump != None: window = min(now - self.lastPump, self.MAX_WINDOW)
+		self.lastPump = now
+		
+		for event in events:
+			setattr(event, self.EVENT_TIME, now - (window / 2.0))
+		return events
+		
+	def getEventTime(self, event):
+		"""
+			The event's capture time, or now for events that
+			didn't come through capture().
+		"""
+		return getattr(event, self.EVENT_TIME, time.time())
+	
+#----------------------------------------------------------
+# BPJudgementStats class
+#----------------------------------------------------------
+class BPJudgementStats(object):
+	"""
+		Running judgement statistics for one play. Every
+		update is O(1): a counter per hit tier, misses and
+		dropped holds, the current and best combo, Welford's
+		running mean and variance of the hit offset, and a
+		fixed-bin histogram of offsets.
+		
+		Offsets are hit time minus note time in seconds, so
+		late hits are positive. Offsets outside the histogram
+		range land in the end bins.
+	"""
+	tierCounts = []
+	misses = 0
+	drops = 0
+	combo = 0
+	maxCombo = 0
+	numOffsets = 0
+	meanOffset = 0.0
+	sumSquares = 0.0
+	histogram = []
+	histogramRange = 0.0
+	
+	def __init__(self, numTiers, histogramRange, numBins):
+		self.tierCounts = [0] * numTiers
+		self.misses = 0
+		self.drops = 0
+		self.combo = 0
+		self.maxCombo = 0
+		self.numOffsets = 0
+		self.meanOffset = 0.0
+		self.sumSquares = 0.0
+		self.histogram = [0] * numBins
+		self.histogramRange = histogramRange
+		
+	def addHit(self, tier, offset):
+		self.tierCounts[tier] = self.tierCounts[tier] + 1
+		self.combo = self.combo + 1
+		self.maxCombo = max(self.maxCombo, self.combo)
+		
+		# Welford's update
+		self.numOffsets = self.numOffsets + 1
+		delta = offset - self.meanOffset
+		self.meanOffset = self.meanOffset + (delta / self.numOffsets)
+		self.sumSquares = self.sumSquares + (delta * (offset - self.meanOffset))
+		
+		numBins = len(self.histogram)
+		i = int((offset + self.histogramRange) / (2.0 * self.histogramRange) * numBins)
+		i = max(min(i, numBins - 1), 0)
+		self.histogram[i] = self.histogram[i] + 1
+		
+	def addMiss(self):
+		self.misses = self.misses + 1
+		self.combo = 0
+		
+	def addDrop(self):
+		self.drops = self.drops + 1
+		self.combo = 0
+		
+	def getVariance(self):
+		if self.numOffsets == 0: return 0.0
+		return self.sumSquares / self.numOffsets
+		
+	def getStdDev(self):
+		return math.sqrt(self.getVariance())
+		
+	def getBinCenter(self, i):
+		binWidth = (2.0 * self.histogramRange) / len(self.histogram)
+		return (-1 * self.histogramRange) + ((i + 0.5) * binWidth)
+		
+	def toArray(self):
+		return array.array('d', [self.misses, self.drops, self.combo, self.maxCombo,
+			self.numOffsets, self.meanOffset, self.sumSquares] + self.tierCounts + self.histogram)
+			
+	def fromArray(self, values):
+		self.misses, self.drops, self.combo, self.maxCombo, self.numOffsets = [int(value) for value in values[:5]]
+		self.meanOffset, self.sumSquares = values[5], values[6]
+		numTiers = len(self.tierCounts)
+		self.tierCounts = [int(value) for value in values[7:7 + numTiers]]
+		self.histogram = [int(value) for value in values[7 + numTiers:]]
+		
+#----------------------------------------------------------
+# BPPlaySnapshot class
+#----------------------------------------------------------
+class BPPlaySnapshot(object):
+	"""
+		Gameplay state at one level time, for rewinding. Only
+		indexes and numbers are kept, as flat arrays: the
+		shared note and beat cursors, and for each player the
+		arrowData indexes of the notes still to be judged and
+		of the held notes (-1 for a free column), the next
+		hold tick times, the score, the arrow type, and the
+		judgement stats
+		(see BPJudgementStats.toArray). Sprites are rebuilt
+		from these on restore.
+	"""
+	levelTime = 0.0
+	nextArrow = 0
+	curBeat = 0
+	lastBeatTime = 0.0
+	scores = None
+	arrowTypes = None
+	live = []
+	holds = []
+	holdTicks = []
+	stats = []
+	
+	def __init__(self, levelTime):
+		self.levelTime = levelTime
+		self.nextArrow = 0
+		self.curBeat = 0
+		self.lastBeatTime = 0.0
+		self.scores = array.array('i')
+		self.arrowTypes = array.array('i')
+		self.live = []
+		self.holds = []
+		self.holdTicks = []
+		self.stats = []
+	
+#----------------------------------------------------------
+# BPNoteField class
+#----------------------------------------------------------
+class BPNoteField(object):
+	"""
+		Maps song time to scroll distance (layout pixels) for
+		a given scroll speed and the chart's speed changes.
+		The map is piecewise linear with a breakpoint at each
+		change, precomputed as arrays of times, distances and
+		rates, so either direction is a bisect and one
+		multiply-add. A note at time t sits getDistance(t) -
+		getDistance(now) pixels past the hit zone.
+		
+		Changes are (time, multiplier) pairs; the multiplier
+		scales the base speed from that time on. The first
+		segment extends back before time 0.
+	"""
+	times = None
+	distances = None
+	rates = None
+	
+	def __init__(self, pixelsPerSecond, scrollSpeed, changes = []):
+		baseRate = float(pixelsPerSecond) * float(scrollSpeed)
+		self.times = array.array('d', [0.0])
+		self.distances = array.array('d', [0.0])
+		self.rates = array.array('d', [baseRate])
+		for changeTime, multiplier in sorted(changes):
+			if multiplier <= 0: raise ValueError('Scroll speed multipliers must be positive: %r' % multiplier)
+			
+			rate = baseRate * multiplier
+			if changeTime <= self.times[-1]:
+				self.rates[-1] = rate
+			else:
+				self.distances.append(self.getDistance(changeTime))
+				self.times.append(changeTime)
+				self.rates.append(rate)
+		
+	def getDistance(self, t):
+		i = max(bisect.bisect_right(self.times, t) - 1, 0)
+		return self.distances[i] + (self.rates[i] * (t - self.times[i]))
+		
+	def getTime(self, distance):
+		i = max(bisect.bisect_right(self.distances, distance) - 1, 0)
+		return self.times[i] + ((distance - self.distances[i]) / self.rates[i])
+	
+#----------------------------------------------------------
+# BPDigitStrip class
+#----------------------------------------------------------
+class BPDigitStrip(object):
+	"""
+		Draws numbers from one strip holding the ten digit
+		images side by side. The last number rendered is kept,
+		so a number that hasn't changed costs nothing to redraw.
+	"""
+	strip = None
+	digitSize = None
+	value = None
+	surface = None
+	
+	def __init__(self, digitImgs):
+		self.digitSize = digitImgs[0].get_size()
+		self.strip = pygame.Surface((self.digitSize[0] * len(digitImgs), self.digitSize[1]), SRCALPHA).convert_alpha()
+		for i in range(len(digitImgs)):
+			self.strip.blit(digitImgs[i], (i * self.digitSize[0], 0))
+		self.value = None
+		self.surface = None
+		
+	def render(self, value):
+		if value == self.value: return self.surface
+		
+		digits = str(value)
+		width, height = self.digitSize
+		self.surface = pygame.Surface((width * len(digits), height), SRCALPHA).convert_alpha()
+		for i in range(len(digits)):
+			self.surface.blit(self.strip, (i * width, 0), (int(digits[i]) * width, 0, width, height))
+		self.value = value
+		return self.surface
+	
+#----------------------------------------------------------
+# BPParticleSystem class
+#----------------------------------------------------------
+class BPParticleSystem(object):
+	"""
+		Spark particles kept in flat arrays rather than one
+		object each. Positions and velocities are in layout
+		pixels; a single pass per frame moves every particle,
+		ages it and swaps dead ones out with the last live
+		particle. The system never holds more than budget
+		particles, bursts past it are cut short.
+		
+		Particles fade by picking one of NUM_ALPHA_FRAMES
+		copies of the image faded ahead of time, so drawing
+		is a single batched blits() call with no per-particle
+		surface work.
+	"""
+	context = None
+	frames = []
+	frameOffset = None
+	budget = 0
+	count = 0
+	posX = None
+	posY = None
+	velX = None
+	velY = None
+	age = None
+	life = None
+	lastTime = None
+	
+	NUM_ALPHA_FRAMES = 8
+	GRAVITY = 600.0				# layout pixels per second squared
+	
+	def __init__(self, context, img, budget):
+		"""
+			Builds the faded frames from img. Images without
+			an alpha channel (e.g. spark.jpg) are keyed on
+			their white background first.
+		"""
+		self.context = context
+		if img.get_bitsize() < 32:
+			img = self.keyWhite(img)
+		else:
+			img = img.convert_alpha()
+		self.frames = []
+		for i in range(self.NUM_ALPHA_FRAMES):
+			frame = img.copy()
+			alpha = int(255 * (i + 1) / self.NUM_ALPHA_FRAMES)
+			frame.fill((255, 255, 255, alpha), None, BLEND_RGBA_MULT)
+			self.frames.append(frame)
+		self.frameOffset = (img.get_width() / 2, img.get_height() / 2)
+		
+		self.budget = budget
+		self.count = 0
+		self.posX = array.array('d', [0.0] * budget)
+		self.posY = array.array('d', [0.0] * budget)
+		self.velX = array.array('d', [0.0] * budget)
+		self.velY = array.array('d', [0.0] * budget)
+		self.age = array.array('d', [0.0] * budget)
+		self.life = array.array('d', [0.0] * budget)
+		self.lastTime = None
+		
+	def keyWhite(self, img):
+		"""
+			Returns a copy of img whose alpha is how far each
+			pixel is from white. Done once per load on the
+			small, already scaled image.
+		"""
+		keyed = img.convert_alpha()
+		keyed.lock()
+		for y in range(keyed.get_height()):
+			for x in range(keyed.get_width()):
+				r, g, b, a = keyed.get_at((x, y))
+				keyed.set_at((x, y), (r, g, b, 255 - min(r, g, b)))
+		keyed.unlock()
+		return keyed
+		
+	def emit(self, pos, num, speed, life):
+		"""
+			Bursts up to num particles out of pos in random
+			directions at up to speed layout pixels per second.
+			Returns how many were emitted.
+		"""
+		num = min(num, self.budget - self.count)
+		for i in range(self.count, self.count + num):
+			angle = random.uniform(0, 2 * math.pi)
+			magnitude = random.uniform(0.25, 1.0) * speed
+			self.posX[i] = pos[0]
+			self.posY[i] = pos[1]
+			self.velX[i] = math.cos(angle) * magnitude
+			self.velY[i] = math.sin(angle) * magnitude
+			self.age[i] = 0.0
+			self.life[i] = random.uniform(0.5, 1.0) * life
+		self.count = self.count + num
+		return num
+		
+	def update(self, now):
+		if self.lastTime == None: self.lastTime = now
+		dt = now - self.lastTime
+		self.lastTime = now
+		
+		posX, posY, velX, velY, age, life = self.posX, self.posY, self.velX, self.velY, self.age, self.life
+		gravity = self.GRAVITY * dt
+		i = 0
+		count = self.count
+		while i < count:
+			age[i] = age[i] + dt
+			if age[i] >= life[i]:	# Swap the last live particle into this slot
+				count = count - 1
+				posX[i], posY[i], velX[i], velY[i], age[i], life[i] = \
+					posX[count], posY[count], velX[count], velY[count], age[count], life[count]
+				continue
+			velY[i] = velY[i] + gravity
+			posX[i] = posX[i] + (velX[i] * dt)
+			posY[i] = posY[i] + (velY[i] * dt)
+			i = i + 1
+		self.count = count
+		
+	def shiftTime(self, delta):
+		if self.lastTime != None: self.lastTime = self.lastTime + delta
+		
+	def clear(self):
+		self.count = 0
+		
+	def draw(self):
+		"""
+			Draws every live particle and returns the screen
+			rects drawn to.
+		"""
+		if self.count == 0: return []
+		
+		scaler = self.context['scaler']
+		frames = self.frames
+		lastFrame = self.NUM_ALPHA_FRAMES - 1
+		offsetX, offsetY = self.frameOffset
+		blits = []
+		for i in range(self.count):
+			frame = frames[int(lastFrame * (1.0 - (self.age[i] / self.life[i])))]
+			x, y = scaler.toScreen((self.posX[i], self.posY[i]))
+			blits.append((frame, (x - offsetX, y - offsetY)))
+		return self.context['surfDisp'].blits(blits)
+	
+#----------------------------------------------------------
+# BPEasing class
+#----------------------------------------------------------
+class BPEasing(object):
+	"""
+		Easing curves for sprite tweens. A curve maps the
+		elapsed fraction of a tween (0 to 1) to the fraction
+		of the way from origin to target, and may overshoot
+		(back, elastic).
+		
+		Curves are sampled once into a table of TABLE_SIZE + 1
+		values and the table is shared by every tween that
+		uses it. Linear tweens have no table. A curve is named
+		by one of the EASE_* constants, or by a tuple of the
+		two control points (x1, y1, x2, y2) of a cubic bezier
+		running from (0, 0) to (1, 1), as in CSS.
+	"""
+	tables = {}
+	
+	EASE_LINEAR = "linear"
+	EASE_IN_QUAD = "in_quad"
+	EASE_OUT_QUAD = "out_quad"
+	EASE_IN_OUT_QUAD = "in_out_quad"
+	EASE_IN_CUBIC = "in_cubic"
+	EASE_OUT_CUBIC = "out_cubic"
+	EASE_IN_OUT_CUBIC = "in_out_cubic"
+	EASE_IN_BACK = "in_back"
+	EASE_OUT_BACK = "out_back"
+	EASE_IN_ELASTIC = "in_elastic"
+	EASE_OUT_ELASTIC = "out_elastic"
+	
+	TABLE_SIZE = 256
+	BACK_OVERSHOOT = 1.70158
+	ELASTIC_PERIOD = 0.3
+	BEZIER_ITERATIONS = 24
+	
+	def __init__(self):
+		self.tables = {}
+		
+	def getTable(self, easing):
+		"""
+			Returns the sampled table for the curve, or None
+			for linear tweens.
+		"""
+		if easing == self.EASE_LINEAR: return None
+		
+		if easing not in self.tables:
+			if isinstance(easing, tuple):
+				curve = lambda t: self.bezier(easing, t)
+			else:
+				curve = self.getCurve(easing)
+			self.tables[easing] = array.array('d', 
+				[curve(float(i) / float(self.TABLE_SIZE)) for i in range(self.TABLE_SIZE + 1)])
+		return self.tables[easing]
+		
+	def getCurve(self, easing):
+		s = self.BACK_OVERSHOOT
+		p = self.ELASTIC_PERIOD
+		curves = {
+			self.EASE_IN_QUAD:lambda t: t * t,
+			self.EASE_OUT_QUAD:lambda t: t * (2 - t),
+			self.EASE_IN_OUT_QUAD:lambda t: 2 * t * t if t < 0.5 else 1 - (2 * (1 - t) * (1 - t)),
+			self.EASE_IN_CUBIC:lambda t: t * t * t,
+			self.EASE_OUT_CUBIC:lambda t: 1 - ((1 - t) ** 3),
+			self.EASE_IN_OUT_CUBIC:lambda t: 4 * t * t * t if t < 0.5 else 1 - (4 * ((1 - t) ** 3)),
+			self.EASE_IN_BACK:lambda t: t * t * (((s + 1) * t) - s),
+			self.EASE_OUT_BACK:lambda t: 1 + ((t - 1) * (t - 1) * (((s + 1) * (t - 1)) + s)),
+			self.EASE_IN_ELASTIC:lambda t: 0.0 if t == 0 else -1 * (2 ** (10 * (t - 1))) * math.sin(((t - 1) - (p / 4)) * (2 * math.pi) / p),
+			self.EASE_OUT_ELASTIC:lambda t: 1.0 if t == 1 else ((2 ** (-10 * t)) * math.sin((t - (p / 4)) * (2 * math.pi) / p)) + 1
+		}
+		return curves[easing]
+		
+	def bezier(self, points, x):
+		"""
+			Evaluates the bezier easing at x by bisecting for
+			the curve parameter whose x coordinate is x. Only
+			used while building tables.
+		"""
+		x1, y1, x2, y2 = points
+		coord = lambda a, b, t: (3 * a * t * (1 - t) * (1 - t)) + (3 * b * t * t * (1 - t)) + (t * t * t)
+		lo, hi = 0.0, 1.0
+		for i in range(self.BEZIER_ITERATIONS):
+			mid = (lo + hi) / 2
+			if coord(x1, x2, mid) < x: lo = mid
+			else: hi = mid
+		return coord(y1, y2, (lo + hi) / 2)
+	
 #----------------------------------------------------------
 # BPSprite class
 #----------------------------------------------------------
@@ -28,7 +1801,10 @@ class BPSprite(object):
 		Basic sprite class. Sprites handle their own
 		animations. Animations are handled as simple
 		actions in a queue and can be blended together.
-		All tweens are linear interpolations (no easing).
+		Tweens are linear unless given an ACTION_EASING
+		curve (see BPEasing). Everything a tween needs is
+		worked out when it's queued, so each frame costs
+		one table lookup and one multiply-add per value.
 	"""
 	context = None
 	data = None
@@ -45,6 +1821,7 @@ class BPSprite(object):
 	ACTION_START_TIME = "start_time"		# start_time of action (defaults to now)
 	ACTION_DURATION = "duration"			# in seconds (defaults to now)
 	ACTION_BLEND = "blend"					# blend with current actions (defaults to False)
+	ACTION_EASING = "easing"				# easing curve for tweens (defaults to linear)
 	
 	# POSITION
 	ACTION_POSITION = "position"			# position action
@@ -68,6 +1845,13 @@ class BPSprite(object):
 	ACTION_SET_IMAGE = "set_img"			# set image action
 	ACTION_SET_IMAGE_INDEX = "set_img_idx"	# image index
 	
+	# COMPILED (filled in by queueAction)
+	ACTION_EASE_TABLE = "ease_table"		# sampled easing curve (None when linear)
+	ACTION_RATE = "rate"					# 1 / duration
+	ACTION_DELTA = "delta"					# target - origin
+	
+	EASING = BPEasing()						# easing tables shared by all sprites
+	
 	def __init__(self, context, data, pos, imgObj, curImg = 0):
 		"""
 			init() method
@@ -86,14 +1870,28 @@ class BPSprite(object):
 		self.alpha = 255
 		self.imgBackup = None
 		
-	def draw(self):
-		if self.terminated == True: return
+	def draw(self, offset = (0, 0), skin = None):
+		"""
+			Draws the sprite moved by offset, with its images
+			swapped for skin if given (see BPSpriteGroup).
+		"""
+		if self.terminated == True or self.alpha <= 0: return
+		
+		imgObj = self.imgObj
+		if skin != None: imgObj = skin
+		img = imgObj[int(self.curImg)]
+		
+		# Cull sprites that are entirely off the window
+		surf = self.context['surfDisp']
+		pos = self.context['scaler'].toScreen((self.pos[0] + offset[0], self.pos[1] + offset[1]))
+		if not surf.get_rect().colliderect(pygame.Rect(pos, img.get_size())): return
 		
 		# Resolve alpha for the image on a copy of the original image
-		img = self.imgObj[int(self.curImg)].copy()
-		img.fill((0, 0, 0, 255 - self.alpha), None, BLEND_RGBA_SUB)
+		if self.alpha < 255:
+			img = img.copy()
+			img.fill((0, 0, 0, 255 - self.alpha), None, BLEND_RGBA_SUB)
 		
-		self.context['surfDisp'].blit(img, self.pos)
+		return surf.blit(img, pos)
 		
 	def queueAction(self, action):
 		"""
@@ -113,6 +1911,20 @@ class BPSprite(object):
 			action[self.ACTION_DURATION] = 0
 		if self.ACTION_ALPHA_ORIGIN not in action.keys():
 			action[self.ACTION_ALPHA_ORIGIN] = self.alpha
+		if self.ACTION_EASING not in action.keys():
+			action[self.ACTION_EASING] = BPEasing.EASE_LINEAR
+			
+		# Compile the tween
+		action[self.ACTION_EASE_TABLE] = self.EASING.getTable(action[self.ACTION_EASING])
+		action[self.ACTION_RATE] = 0
+		if action[self.ACTION_DURATION] != 0:
+			action[self.ACTION_RATE] = float(1) / float(action[self.ACTION_DURATION])
+		if action[self.ACTION_IDENTIFIER] == self.ACTION_POSITION:
+			action[self.ACTION_DELTA] = (
+				action[self.ACTION_POSITION_TARGET][0] - action[self.ACTION_POSITION_ORIGIN][0],
+				action[self.ACTION_POSITION_TARGET][1] - action[self.ACTION_POSITION_ORIGIN][1])
+		elif action[self.ACTION_IDENTIFIER] == self.ACTION_ALPHA:
+			action[self.ACTION_DELTA] = action[self.ACTION_ALPHA_TARGET] - action[self.ACTION_ALPHA_ORIGIN]
 
 		# Insert the action in sorted order according to start time
 		inserted = False
@@ -131,23 +1943,25 @@ class BPSprite(object):
 		"""
 		if self.terminated == True: return
 		
-		elapsed = time.time() - action[self.ACTION_START_TIME]
 		percElapsed = 0
 		if action[self.ACTION_DURATION] == 0:
 			percElapsed = 100
 		else:
-			percElapsed = float(elapsed) / float(action[self.ACTION_DURATION])
+			percElapsed = (time.time() - action[self.ACTION_START_TIME]) * action[self.ACTION_RATE]
+		
+		# Eased progress, clamped to the end of the tween
+		table = action[self.ACTION_EASE_TABLE]
+		if table == None:
+			progress = min(percElapsed, 1)
+		else:
+			progress = table[int(min(percElapsed, 1) * BPEasing.TABLE_SIZE)]
 		
 		if action[self.ACTION_IDENTIFIER] == self.ACTION_POSITION:
-			dx = action[self.ACTION_POSITION_TARGET][0] - action[self.ACTION_POSITION_ORIGIN][0]
-			dy = action[self.ACTION_POSITION_TARGET][1] - action[self.ACTION_POSITION_ORIGIN][1]
-			tx = action[self.ACTION_POSITION_ORIGIN][0] + (percElapsed * dx)
-			ty = action[self.ACTION_POSITION_ORIGIN][1] + (percElapsed * dy)
-			self.pos = (tx, ty)
+			origin = action[self.ACTION_POSITION_ORIGIN]
+			delta = action[self.ACTION_DELTA]
+			self.pos = (origin[0] + (progress * delta[0]), origin[1] + (progress * delta[1]))
 		elif action[self.ACTION_IDENTIFIER] == self.ACTION_ALPHA:
-			self.imgObj[int(self.curImg)] = self.imgObj[int(self.curImg)].copy()
-			delta = (action[self.ACTION_ALPHA_TARGET] - action[self.ACTION_ALPHA_ORIGIN]) * percElapsed
-			self.alpha = max(min(action[self.ACTION_ALPHA_ORIGIN] + delta, 255), 0)
+			self.alpha = max(min(action[self.ACTION_ALPHA_ORIGIN] + (progress * action[self.ACTION_DELTA]), 255), 0)
 		elif action[self.ACTION_IDENTIFIER] == self.ACTION_CALLBACK:
 			if self.ACTION_CALLBACK_FUNCTION in action.keys():
 				action[self.ACTION_CALLBACK_FUNCTION](self)
@@ -171,6 +1985,132 @@ class BPSprite(object):
 			if time.time() >= action[self.ACTION_START_TIME] and (action == self.actions[0] or 
 				action[self.ACTION_BLEND] == True or action[self.ACTION_IDENTIFIER] == self.ACTION_TERMINATE):
 				self.handleAction(action)
+				
+	def shiftTime(self, delta):
+		"""
+			Moves every queued action delta seconds later,
+			e.g. by the time spent paused.
+		"""
+		for action in self.actions:
+			action[self.ACTION_START_TIME] = action[self.ACTION_START_TIME] + delta
+	
+#----------------------------------------------------------
+# BPSpriteGroup class
+#----------------------------------------------------------
+class BPSpriteGroup(object):
+	"""
+		A node in the scene graph: sprites that update and
+		draw together. Group settings apply to every sprite
+		in the group at once:
+		
+		- offset moves the whole group (layout pixels)
+		- skin, when set, replaces each sprite's images
+		- a group that isn't visible is skipped entirely
+		
+		bounds is the group's area in layout pixels before
+		its offset. A group whose bounds are moved fully off
+		the layout is culled like a hidden one. Sprites in a
+		skipped group don't update, so their timed actions
+		catch up when the group comes back.
+		
+		Sprites leave a group by being retired: they stop
+		updating and drawing at once, and the group drops
+		all of them in one pass on its next update.
+		
+		underlay, if given, is called with the group before
+		its sprites are drawn and returns the rects it drew.
+		data is whatever the group's owner wants kept with it.
+	"""
+	context = None
+	data = None
+	z = 0
+	sprites = []
+	offset = (0, 0)
+	skin = None
+	visible = True
+	bounds = None
+	underlay = None
+	numRetired = 0
+	
+	def __init__(self, context, z, bounds = None, underlay = None, data = None):
+		self.context = context
+		self.data = data
+		self.z = z
+		self.sprites = []
+		self.offset = (0, 0)
+		self.skin = None
+		self.visible = True
+		self.bounds = bounds
+		self.underlay = underlay
+		self.numRetired = 0
+		
+	def add(self, sprite):
+		self.sprites.append(sprite)
+		
+	def retire(self, sprite):
+		sprite.terminated = True
+		self.numRetired = self.numRetired + 1
+		
+	def isCulled(self):
+		if self.visible == False: return True
+		if self.bounds == None: return False
+		
+		layoutRect = pygame.Rect((0, 0), self.context['layoutSize'])
+		return not layoutRect.colliderect(pygame.Rect(self.bounds).move(self.offset))
+		
+	def update(self):
+		if self.numRetired > 0:
+			self.sprites = [sprite for sprite in self.sprites if sprite.terminated == False]
+			self.numRetired = 0
+		for sprite in list(self.sprites): sprite.update()
+		
+	def shiftTime(self, delta):
+		for sprite in self.sprites: sprite.shiftTime(delta)
+		
+	def draw(self):
+		rects = []
+		if self.underlay != None: rects.extend(self.underlay(self))
+		for sprite in self.sprites:
+			rect = sprite.draw(self.offset, self.skin)
+			if rect != None: rects.append(rect)
+		return rects
+	
+#----------------------------------------------------------
+# BPScene class
+#----------------------------------------------------------
+class BPScene(object):
+	"""
+		Sprite groups kept in z order, lowest first. Groups
+		with equal z keep the order they were added in.
+		Culled groups are dropped before any of their
+		sprites are updated or drawn.
+	"""
+	groups = []
+	
+	def __init__(self):
+		self.groups = []
+		
+	def addGroup(self, group):
+		i = len(self.groups)
+		while i > 0 and self.groups[i - 1].z > group.z: i = i - 1
+		self.groups.insert(i, group)
+		return group
+		
+	def removeGroup(self, group):
+		self.groups.remove(group)
+		
+	def update(self):
+		for group in self.groups:
+			if group.isCulled() == False: group.update()
+			
+	def shiftTime(self, delta):
+		for group in self.groups: group.shiftTime(delta)
+		
+	def draw(self):
+		rects = []
+		for group in self.groups:
+			if group.isCulled() == False: rects.extend(group.draw())
+		return rects
 	
 #----------------------------------------------------------
 # BPController class
@@ -236,49 +2176,470 @@ class BPController(object):
 			self.handleEvent(event)
 		else:
 			self.child.onEvent(event)
+			
+	def onSimulate(self, simTime):
+		if self.child == None:
+			self.handleSimulate(simTime)
+		else:
+			self.child.onSimulate(simTime)
 		
 	def onChildExit(self):
 		self.child = None
 		self.handleChildExit()	
 		
-	#--- Begin Handlers (override these as you please)
-	
-	def start(self):
-		pass
+	def onShutdown(self):
+		if self.child != None: self.child.onShutdown()
+		self.handleShutdown()
+		
+	#--- Begin Handlers (override these as you please)
+	
+	def start(self):
+		pass
+		
+	def handleChildExit(self):
+		pass
+		
+	def handleShutdown(self):
+		"""
+			The game is quitting. Called on every controller
+			in the stack, innermost first, to save whatever
+			would otherwise be lost.
+		"""
+		pass
+		
+	def handleEvent(self, event):
+		pass
+		
+	def handleUpdate(self):
+		pass
+		
+	def handleSimulate(self, simTime):
+		"""
+			Fixed-rate simulation step (BPGame.SIM_RATE), run
+			between frames. simTime is in time.time() seconds.
+		"""
+		pass
+
+#----------------------------------------------------------
+# BPLaunchController class
+#----------------------------------------------------------
+class BPLaunchController(BPController):
+	"""
+		Renders the start screen and waits for a keypress.
+	"""
+	def __init__(self, parent, context):
+		BPController.__init__(self, parent, context)
+		
+	def start(self):
+		startImg = self.context['scaler'].load('bg_start.png', self.context['windowSize']).convert()			
+		self.context['surfDisp'].blit(startImg, (0, 0))
+		
+	def handleEvent(self, event):
+		if event.type == KEYDOWN:
+			self.exit()
+			
+#----------------------------------------------------------
+# BPSongSelectController class
+#----------------------------------------------------------
+class BPSongSelectController(BPController):
+	"""
+		Lists the songs in the library and plays a preview of
+		the highlighted one. Previews and backgrounds for the
+		highlighted song and its neighbours are loaded by a
+		BPPreviewLoader. Only the visible rows are drawn and
+		their title text is cached, so scrolling costs the
+		same however long the list is.
+	"""
+	levels = []
+	selected = 0
+	loader = None
+	font = None
+	titles = None
+	imgBG = None
+	bgLevel = None
+	previewLevel = None
+	preview = None
+	imgSpeed = None
+	speedShown = None
+	best = None
+	bestLevel = None
+	imgBest = None
+	
+	KEYS_PREV = [K_UP, K_i]			# Move the highlight up
+	KEYS_NEXT = [K_DOWN, K_k]		# Move the highlight down
+	KEYS_CHOOSE = [K_RETURN, K_SPACE]	# Play the highlighted song
+	KEYS_CALIBRATE = [K_c]			# Calibrate latency against the highlighted song
+	KEYS_SLOWER = [K_LEFT, K_j]		# Lower the scroll speed
+	KEYS_FASTER = [K_RIGHT, K_l]	# Raise the scroll speed
+	KEYS_PRACTICE = [K_p]			# Toggle practice mode (rewind, scores not saved)
+	KEYS_PLAYERS = [K_TAB]			# Change the number of players
+	
+	SCROLL_SPEEDS = (0.5, 0.75, 1.0, 1.25, 1.5, 2.0, 2.5, 3.0, 4.0)	# Scroll speed multipliers to pick from
+	SPEED_TEXT_POS = (60, 500)		# Position of the scroll speed text
+	BEST_TEXT_POS = (600, 500)		# Position of the personal best text
+	
+	NUM_VISIBLE_ROWS = 9			# Rows drawn around the highlighted song
+	NUM_PREFETCH_NEIGHBOURS = 2		# Songs either side whose previews are loaded early
+	TITLE_CACHE_SIZE = 64			# Rendered title surfaces kept
+	ROW_HEIGHT = 44					# Height of each row
+	ROW_X = 60						# Left edge of the rows
+	FONT_SIZE = 36					# Title font size
+	TITLE_COLOR = (255, 255, 255)
+	SELECTED_COLOR = (255, 210, 60)
+	BG_COLOR = (0, 0, 0)
+	PREVIEW_FADE_MS = 500			# Preview fade in/out
+	EMPTY_TEXT = 'No songs found in %s'	# Shown instead of the list when the library is empty
+	
+	def __init__(self, parent, context):
+		BPController.__init__(self, parent, context)
+		self.levels = []
+		self.selected = 0
+		self.loader = None
+		self.font = None
+		self.titles = collections.OrderedDict()
+		self.imgBG = None
+		self.bgLevel = None
+		self.previewLevel = None
+		self.preview = None
+		self.imgSpeed = None
+		self.speedShown = None
+		self.best = None
+		self.bestLevel = None
+		self.imgBest = None
+		
+	def start(self):
+		library = self.context['library']
+		self.levels = library.querySongs()
+		if 'level' in self.context and self.context['level'] in self.levels:
+			self.selected = self.levels.index(self.context['level'])
+		self.font = pygame.font.Font(None, self.context['scaler'].toScreenLength(self.FONT_SIZE))
+		if len(self.levels) == 0: return
+		self.loader = BPPreviewLoader(library, self.context['scaler'], (2 * self.NUM_PREFETCH_NEIGHBOURS) + 1)
+		self.loader.start()
+		self.select(self.selected)
+		
+	def select(self, index):
+		self.selected = index % len(self.levels)
+		
+		# Highlighted song first, then its neighbours outwards
+		wanted = [self.levels[self.selected]]
+		for i in range(1, self.NUM_PREFETCH_NEIGHBOURS + 1):
+			wanted.append(self.levels[(self.selected + i) % len(self.levels)])
+			wanted.append(self.levels[(self.selected - i) % len(self.levels)])
+		self.loader.want(wanted)
+		
+	def stopPreview(self):
+		if self.preview != None: self.preview.fadeout(self.PREVIEW_FADE_MS)
+		self.preview = None
+		self.previewLevel = None
+		
+	def getTitle(self, level, color):
+		key = (level, color)
+		if key in self.titles:
+			self.titles[key] = self.titles.pop(key)
+		else:
+			title = self.context['library'].getSong(level)[self.context['library'].SONG_KEY_TITLE]
+			self.titles[key] = self.font.render(title, True, color)
+			while len(self.titles) > self.TITLE_CACHE_SIZE: self.titles.popitem(False)
+		return self.titles[key]
+		
+	def changeSpeed(self, step):
+		speeds = self.SCROLL_SPEEDS
+		current = min(range(len(speeds)), key = lambda i: abs(speeds[i] - self.context['scrollSpeed']))
+		self.context['scrollSpeed'] = speeds[max(0, min(current + step, len(speeds) - 1))]
+		
+	def getSpeedText(self):
+		shown = (self.context['scrollSpeed'], self.context['practiceMode'], self.context['numPlayers'])
+		if self.speedShown != shown:
+			self.speedShown = shown
+			text = 'Speed x%g' % self.context['scrollSpeed']
+			if self.context['practiceMode'] == True: text = text + '  Practice'
+			if self.context['numPlayers'] > 1: text = text + '  %d Players' % self.context['numPlayers']
+			self.imgSpeed = self.font.render(text, True, self.TITLE_COLOR)
+		return self.imgSpeed
+		
+	def getBestText(self):
+		"""
+			The first player's best score on the highlighted
+			song, or None until the leaderboard has answered.
+		"""
+		level = self.levels[self.selected]
+		if self.bestLevel != level:
+			library = self.context['library']
+			self.best = self.context['leaderboard'].getPersonalBest(
+				library.getSong(level)[library.SONG_KEY_HASH], self.context['playerNames'][0])
+			self.bestLevel = level
+			self.imgBest = None
+		if self.imgBest == None and self.best.done():
+			result = self.best.result()
+			text = 'Best -'
+			if result != None: text = 'Best %d' % result[BPLeaderboard.RESULT_KEY_SCORE]
+			self.imgBest = self.font.render(text, True, self.TITLE_COLOR)
+		return self.imgBest
+		
+	def updateSelection(self):
+		"""
+			Picks up the highlighted song's background and
+			preview once the loader has them.
+		"""
+		level = self.levels[self.selected]
+		if self.bgLevel != level:
+			img = self.loader.getBackground(level)
+			if img != None:
+				self.imgBG = img.convert()
+				self.bgLevel = level
+				
+		if self.previewLevel != level:
+			preview = self.loader.getPreview(level)
+			if preview != None:
+				self.stopPreview()
+				self.preview = preview
+				self.previewLevel = level
+				if self.context['musicEnabled'] == True:
+					self.preview.play(-1, 0, self.PREVIEW_FADE_MS)
+		
+	def drawEmpty(self):
+		surf = self.context['surfDisp']
+		surf.fill(self.BG_COLOR)
+		text = self.font.render(self.EMPTY_TEXT % os.path.abspath(self.context['library'].songsDir), True, self.TITLE_COLOR)
+		surf.blit(text, ((surf.get_width() - text.get_width()) / 2, (surf.get_height() - text.get_height()) / 2))
 		
-	def handleChildExit(self):
-		pass
+	def handleUpdate(self):
+		if len(self.levels) == 0:
+			self.drawEmpty()
+			return
+		self.updateSelection()
 		
+		surf = self.context['surfDisp']
+		if self.imgBG != None:
+			surf.blit(self.imgBG, (0, 0))
+		else:
+			surf.fill(self.BG_COLOR)
+			
+		centerY = (self.context['layoutSize'][1] - self.ROW_HEIGHT) / 2.0
+		half = self.NUM_VISIBLE_ROWS // 2
+		for row in range(-1 * half, half + 1):
+			index = self.selected + row
+			if index < 0 or index >= len(self.levels): continue
+			color = self.TITLE_COLOR
+			if row == 0: color = self.SELECTED_COLOR
+			surf.blit(
+				self.getTitle(self.levels[index], color), 
+				self.context['scaler'].toScreen((self.ROW_X, centerY + (row * self.ROW_HEIGHT))))
+		surf.blit(self.getSpeedText(), self.context['scaler'].toScreen(self.SPEED_TEXT_POS))
+		imgBest = self.getBestText()
+		if imgBest != None: surf.blit(imgBest, self.context['scaler'].toScreen(self.BEST_TEXT_POS))
+			
 	def handleEvent(self, event):
-		pass
+		if event.type != KEYDOWN or len(self.levels) == 0: return
 		
-	def handleUpdate(self):
-		pass
-
+		if event.key in self.KEYS_PREV:
+			self.select(self.selected - 1)
+		elif event.key in self.KEYS_NEXT:
+			self.select(self.selected + 1)
+		elif event.key in self.KEYS_SLOWER:
+			self.changeSpeed(-1)
+		elif event.key in self.KEYS_FASTER:
+			self.changeSpeed(1)
+		elif event.key in self.KEYS_PRACTICE:
+			self.context['practiceMode'] = not self.context['practiceMode']
+		elif event.key in self.KEYS_PLAYERS:
+			self.context['numPlayers'] = (self.context['numPlayers'] % len(BPGameplayController.PLAYER_KEYS)) + 1
+		elif event.key in self.KEYS_CHOOSE:
+			self.context['level'] = self.levels[self.selected]
+			self.stopPreview()
+			self.loader.stop()
+			self.exit()
+		elif event.key in self.KEYS_CALIBRATE:
+			self.context['level'] = self.levels[self.selected]
+			self.stopPreview()
+			self.launchChild(BPCalibrationController(self, self.context))
+			
 #----------------------------------------------------------
-# BPLaunchController class
+# BPCalibrationController class
 #----------------------------------------------------------
-class BPLaunchController(BPController):
+class BPCalibrationController(BPController):
 	"""
-		Renders the start screen and waits for a keypress.
+		Measures this machine's input and audio latency. The
+		highlighted song plays as a metronome, its beats from
+		beats_N.txt flashing on screen, and the player taps
+		along. Tap offsets from the nearest beat are collected,
+		outliers more than OUTLIER_MADS median absolute
+		deviations from the median are thrown out, and the
+		mean of the rest becomes context['globalOffset'].
+		
+		Gameplay shifts its level clock by the offset, which
+		moves judgement and note rendering together. The value
+		is saved to context['calibrationFile'].
 	"""
+	beats = []
+	offsets = []
+	music = None
+	timeStart = 0.0
+	font = None
+	imgFlash = None
+	curBeat = 0
+	
+	KEYS_TAP = [K_j, K_k, K_i, K_l, K_SPACE]	# Any of these count as a tap
+	KEY_CANCEL = K_ESCAPE						# Leave without saving
+	
+	NUM_TAPS = 32					# Taps collected before the offset is computed
+	OUTLIER_MADS = 3.0				# Taps further than this many MADs from the median are rejected
+	FLASH_TIME = 0.1				# Seconds the beat flash stays lit
+	FLASH_POS = (450, 230)			# Beat flash position (layout pixels)
+	TEXT_POS = (300, 330)			# Status text position (layout pixels)
+	FONT_SIZE = 36
+	TEXT_COLOR = (255, 255, 255)
+	BG_COLOR = (0, 0, 0)
+	
 	def __init__(self, parent, context):
 		BPController.__init__(self, parent, context)
+		self.beats = []
+		self.offsets = []
+		self.music = None
+		self.timeStart = 0.0
+		self.font = None
+		self.imgFlash = None
+		self.curBeat = 0
 		
 	def start(self):
-		startImg = pygame.image.load('bg_start.png').convert()			
-		self.context['surfDisp'].blit(startImg, (0, 0))
+		library = self.context['library']
+		level = self.context.get('level', library.getLevels()[0])
+		self.beats = library.loadBeats(level)
+		self.font = pygame.font.Font(None, self.context['scaler'].toScreenLength(self.FONT_SIZE))
+		self.imgFlash = self.context['scaler'].load('arrow_hud_flash_1.png').convert_alpha()
+		self.music = pygame.mixer.Sound(library.getSong(level)[library.SONG_KEY_SONG_FILE])
+		if self.context['musicEnabled'] == True:
+			self.music.play()
+		self.timeStart = time.time()
+		
+	def computeOffset(self, offsets):
+		"""
+			Mean of the offsets after rejecting outliers by
+			median absolute deviation.
+		"""
+		ordered = sorted(offsets)
+		median = ordered[len(ordered) // 2]
+		deviations = sorted([abs(offset - median) for offset in offsets])
+		mad = deviations[len(deviations) // 2]
+		kept = [offset for offset in offsets if abs(offset - median) <= self.OUTLIER_MADS * mad]
+		if len(kept) == 0: kept = [median]
+		return sum(kept) / float(len(kept))
+		
+	def finish(self, save):
+		self.music.stop()
+		if save == True:
+			self.context['globalOffset'] = self.computeOffset(self.offsets)
+			with open(self.context['calibrationFile'], 'w') as f:
+				f.write('%f\n' % self.context['globalOffset'])
+		self.exit()
+		
+	def handleSimulate(self, simTime):
+		songTime = simTime - self.timeStart
+		while self.curBeat < len(self.beats) - 1 and songTime >= self.beats[self.curBeat + 1]:
+			self.curBeat = self.curBeat + 1
+			
+	def handleUpdate(self):
+		surf = self.context['surfDisp']
+		scaler = self.context['scaler']
+		surf.fill(self.BG_COLOR)
+		
+		songTime = time.time() - self.timeStart
+		if self.beats[self.curBeat] <= songTime < self.beats[self.curBeat] + self.FLASH_TIME:
+			surf.blit(self.imgFlash, scaler.toScreen(self.FLASH_POS))
+		text = 'Tap on the beat  %d / %d' % (len(self.offsets), self.NUM_TAPS)
+		surf.blit(self.font.render(text, True, self.TEXT_COLOR), scaler.toScreen(self.TEXT_POS))
 		
 	def handleEvent(self, event):
-		if event.type == KEYDOWN:
-			self.exit()
+		if event.type != KEYDOWN: return
+		
+		if event.key == self.KEY_CANCEL:
+			self.finish(False)
+		elif event.key in self.KEYS_TAP:
+			songTime = self.context['input'].getEventTime(event) - self.timeStart
+			i = bisect.bisect_left(self.beats, songTime)
+			nearest = min(self.beats[max(i - 1, 0):i + 1], key = lambda beat: abs(beat - songTime))
+			self.offsets.append(songTime - nearest)
+			if len(self.offsets) >= self.NUM_TAPS: self.finish(True)
+			
+#----------------------------------------------------------
+# BPPlayer class
+#----------------------------------------------------------
+class BPPlayer(object):
+	"""
+		One player's note field in gameplay: the notes still
+		to be judged, held notes, score and judgement stats,
+		and the scene groups the field is drawn with. Every
+		group is moved by the field's offset, so sprites are
+		placed as if on a single centered field. Players only
+		share the chart, audio and beat; judging one never
+		touches another.
+		
+		onMiss is called with the player when one of its
+		notes passes the hit zone unhit.
+	"""
+	index = 0
+	keys = []
+	offset = (0, 0)
+	onMiss = None
+	sprites = None
+	activeHolds = []
+	nextHoldTicks = []
+	arrowType = 0
+	score = 0
+	stats = None
+	hudFlashGroup = None
+	laneGroups = []
+	scoreGroup = None
+	comboGroup = None
+	flasherGroup = None
+	
+	def __init__(self, index, keys, offset, numColumns, onMiss):
+		self.index = index
+		self.keys = keys
+		self.offset = offset
+		self.onMiss = onMiss
+		self.sprites = collections.deque()
+		self.activeHolds = [None] * numColumns
+		self.nextHoldTicks = [0.0] * numColumns
+		self.arrowType = 0
+		self.score = 0
+		self.stats = None
+		self.hudFlashGroup = None
+		self.laneGroups = []
+		self.scoreGroup = None
+		self.comboGroup = None
+		self.flasherGroup = None
+		
+	def removeSprite(self, sprite):
+		self.laneGroups[sprite.data[BPGameplayController.ARROW_TIMING_KEY_KEY]].retire(sprite)
+		
+	def removeFlasher(self, sprite):
+		self.flasherGroup.retire(sprite)
+		
+	def retireNotes(self):
+		"""
+			Drops retired notes from the front of the
+			judgement queue. Notes are missed in the order
+			they were spawned and hits always take the front
+			note, so retired notes never sit behind live ones.
+		"""
+		while len(self.sprites) > 0 and self.sprites[0].terminated == True:
+			self.sprites.popleft()
 			
+	def arrowMissDelegate(self, sprite):
+		self.removeSprite(sprite)
+		self.stats.addMiss()
+		self.onMiss(self)
+		
 #----------------------------------------------------------
 # BPGameplayController class
 #----------------------------------------------------------
 class BPGameplayController(BPController):
 	"""
-		The main gameplay state controller. 
+		The main gameplay state controller. The chart, song
+		and beat are shared by context['numPlayers'] players
+		(see BPPlayer), each judged on their own note field.
 	"""
 	levelData = []
 	imgArrows = []
@@ -287,38 +2648,72 @@ class BPGameplayController(BPController):
 	imgTextFlashers = []
 	imgScoreNums = []
 	imgBG = None
+	imgBGLayer = None
+	bgLayerKey = None
 	imgHitFlasher = None
 	imgMissFlasher = None
-	sprites = []
-	flashers = []
-	scoreDigits = []
-	keystrokes = []
+	imgComboText = None
+	comboDigits = None
+	sparks = None
+	players = []
+	keyMap = {}
+	pads = []
+	padMap = {}
+	drawnRects = []
+	erasedRects = None
+	scene = None
+	sparkGroup = None
+	openPresses = []
+	recordedNotes = None
+	chartWriter = None
 	arrowData = []
+	nextArrow = 0
+	noteField = None
+	scrollDistance = 0.0
 	beats = []
-	hudArrowFlashers = []
-	arrowType = 0
-	score = 0
+	holdBodies = {}
 	curBeat = 0
 	lastBeatTime = 0.0
+	beatImg = 0
 	timingFile = None
 	beatFile = None
 	bgFile = None
 	songFile = None
+	songLength = 0.0
+	timePlayed = 0.0
+	musicChannel = None
+	songRaw = None
+	paused = False
+	timePaused = 0.0
+	imgPaused = None
+	snapshots = None
+	nextSnapshotTime = 0.0
 	
-	KEYS = [K_j, K_k, K_i, K_l]		# Using ijkl as the keypad (bigger keys, easier to press)
+	PLAYER_KEYS = (					# Keypad for each player, Left, Down, Up, Right
+		[K_j, K_k, K_i, K_l],		# Using ijkl as the keypad (bigger keys, easier to press)
+		[K_a, K_s, K_w, K_d],
+		[K_LEFT, K_DOWN, K_UP, K_RIGHT])
+	PAD_BUTTONS = [0, 1, 2, 3]		# Joystick/dance pad buttons, Left, Down, Up, Right (pad i plays for player i)
 	KEY_QUIT_RECORDING = K_SPACE	# Stops a recording session
+	KEYS_PAUSE = [K_p, K_ESCAPE]	# Pause and resume
+	KEYS_REWIND = [K_BACKSPACE]		# Rewind (practice mode)
 
 	NUM_ARROW_DIRECTIONS = 4		# Left, Down, Up, Right
 	NUM_ARROW_TYPES = 4				# Green, Orange, Pink, Blue
 	NUM_ARROW_STATES = 3			# 1-bar fill, 2-bar fill, 3-bar fill
 	
+	# Sizes and positions below are in layout pixels (see BPScaler)
 	IMG_ARROW_SIZE = (60, 60)		# Dimensions of the arrow images
 	HUD_ARROW_START_POS = (352, 50)	# Start position for the HUD arrows
 	ARROW_COLUMN_PAD = 5
 	ARROW_TIMING_KEY_DOWN = 'down'	# Dictionary key
 	ARROW_TIMING_KEY_UP = 'up'		# Dictionary key
 	ARROW_TIMING_KEY_KEY = 'key'	# Dictionary key
-	ARROW_TIME_BOTTOM_TO_TOP = 3	# Time for arrow to go from bottom of screen to top 
+	ARROW_TIMING_KEY_HEAD = 'head'	# Dictionary key (scroll distance of the down time)
+	ARROW_TIMING_KEY_TAIL = 'tail'	# Dictionary key (scroll distance of the up time)
+	ARROW_TIMING_KEY_SPAWN = 'spawn'	# Dictionary key (level time the arrow comes on screen)
+	ARROW_TIMING_KEY_INDEX = 'index'	# Dictionary key (position in arrowData)
+	ARROW_TIME_BOTTOM_TO_TOP = 3	# Time for arrow to go from bottom of screen to top at 1x speed
 	ARROW_FADE_TIME = 0.2			# Time to fade arrow to 0 alpha after past hit zone
 	
 	HIT_THRESHOLDS = (0.05, 0.1, 0.15)		# Hit thresholds for scoring
@@ -326,19 +2721,55 @@ class BPGameplayController(BPController):
 	NUM_HIT_TEXT_FLASHERS = 4				# Num hit text flasher images
 	HIT_TEXT_FLASHER_SIZE = (81, 15)		# Size of hit flasher text images
 	
+	SPARK_SIZE = 20							# spark particle size
+	SPARK_BUDGET = 256						# most spark particles alive at once
+	SPARK_COUNTS = (24, 14, 6)				# sparks per hit for each hit threshold
+	SPARK_SPEED = 320						# fastest spark speed (pixels per second)
+	SPARK_LIFE = 0.45						# longest spark lifetime (seconds)
+	
 	MISS_FLASHER_SIZE = (269, 49)
 	MISS_FLASHER_Y = 290					# y-coord for miss flasher
 	MISS_FLASHER_FADE_TIME = 0.5			# miss flasher fade time
 	MISS_FLASHER_INDICATOR = 'miss'			# how we remember which flashers are miss flashers
 	
+	Z_HUD_FLASH = 0							# scene z-order, lowest drawn first
+	Z_LANES = 1
+	Z_SPARKS = 2
+	Z_SCORE = 3
+	Z_COMBO = 4
+	Z_FLASHERS = 5
+	
 	NUM_SCORE_DIGITS = 6					# number of digits in our score
 	SCORE_VALUES = [10, 5, 1]				# score values for each hit threshold
 	SCORE_DIGIT_OFFSET = (10, 10)			# offset from the top right for first score digit
 	SCORE_DIGIT_SIZE = (49, 49)				# size of each score digit image	
 	SCORE_DIGIT_PAD = 0		 				# pad between score digits
+	MULTI_SCORE_Y = 481						# y-coord for the score digits under each field (2+ players)
+	
+	COMBO_MIN_DISPLAY = 4					# smallest combo shown
+	COMBO_DIGITS_Y = 360					# y-coord for the combo count
+	COMBO_TEXT_Y = 410						# y-coord for the combo text
+	HISTOGRAM_BINS = 31						# hit offset histogram bins across the widest hit threshold
+	
+	HOLD_MIN_DURATION = 0.25				# notes held at least this long (seconds) are hold notes
+	HOLD_BODY_ALPHA = 160					# alpha of the hold body texture
+	HOLD_TICK_TIME = 0.1					# seconds between sustained score ticks
+	SCORE_HOLD_TICK = 1						# score value for each sustained tick
+	
+	END_DELAY = 1.0							# seconds after the chart and audio end before the results
+	
+	SNAPSHOT_INTERVAL = 1.0					# seconds between rewind snapshots (practice mode)
+	NUM_SNAPSHOTS = 10						# snapshots kept
+	REWIND_TIME = 3.0						# seconds a rewind goes back, at least
+	PAUSED_FONT_SIZE = 48
+	PAUSED_TEXT_Y = 230						# y-coord for the paused text
+	PAUSED_COLOR = (255, 255, 255)
 	
 	#--- RECORDING MODE ---#
 	RECORDING_MODE = False
+	RECORDING_TEXT_FILE = 'timing_%d.txt'	# Text chart written by a recording session
+	RECORDING_BINARY_FILE = 'timing_%d.bin'	# Binary chart written by a recording session
+	RECORDING_BATCH_SIZE = 16				# Notes buffered before appending to disk
 	
 	def __init__(self, parent, context):
 		BPController.__init__(self, parent, context)
@@ -350,240 +2781,486 @@ class BPGameplayController(BPController):
 		self.imgScoreNums = []
 		self.imgMissFlasher = None
 		self.imgBG = None
+		self.imgBGLayer = None
+		self.bgLayerKey = None
 		self.imgHitFlasher = None
-		self.sprites = []
-		self.flashers = []
-		self.keystrokes = []
+		self.imgComboText = None
+		self.comboDigits = None
+		self.sparks = None
+		self.players = []
+		self.keyMap = {}
+		self.pads = []
+		self.padMap = {}
+		self.drawnRects = []
+		self.erasedRects = None
+		self.scene = None
+		self.sparkGroup = None
+		self.openPresses = []
+		self.recordedNotes = None
+		self.chartWriter = None
 		self.arrowData = []
+		self.nextArrow = 0
+		self.noteField = None
+		self.scrollDistance = 0.0
 		self.beats = []
-		self.hudArrowFlashers = []
-		self.arrowType = 0
-		self.score = 0
+		self.holdBodies = {}
 		self.curBeat = 0
 		self.lastBeatTime = 0.0
+		self.beatImg = 0
 		self.timingFile = None
 		self.beatFile = None
 		self.bgFile = None
 		self.songFile = None
+		self.songLength = 0.0
+		self.timePlayed = 0.0
+		self.musicChannel = None
+		self.songRaw = None
+		self.paused = False
+		self.timePaused = 0.0
+		self.imgPaused = None
+		self.snapshots = collections.deque(maxlen = self.NUM_SNAPSHOTS)
+		self.nextSnapshotTime = self.SNAPSHOT_INTERVAL
 		
 	def getColPosX(self, col):
 		return self.HUD_ARROW_START_POS[0] + (col * self.IMG_ARROW_SIZE[0]) + (col * self.ARROW_COLUMN_PAD)
 		
+	def getBGLayer(self):
+		"""
+			Returns the background with every field's HUD
+			arrows baked in. The layer is rebuilt only when the
+			window size, level background or number of players
+			changes, or after a call to invalidateBGLayer()
+			(e.g. on a HUD skin change).
+		"""
+		key = (self.context['windowSize'], self.bgFile, len(self.players))
+		if self.imgBGLayer == None or self.bgLayerKey != key:
+			layer = pygame.Surface(self.context['windowSize']).convert()
+			layer.blit(self.imgBG, (0, 0))
+			for player in self.players:
+				for i in range(self.NUM_ARROW_DIRECTIONS):
+					layer.blit(
+						self.imgHUDArrows[i], 
+						self.context['scaler'].toScreen(
+							(self.getColPosX(i) + player.offset[0], self.HUD_ARROW_START_POS[1] + player.offset[1])))
+			self.imgBGLayer = layer
+			self.bgLayerKey = key
+			self.drawnRects = None		# Whole window needs redrawing
+		return self.imgBGLayer
+		
+	def invalidateBGLayer(self):
+		self.imgBGLayer = None
+		
+	def trackRect(self, rect):
+		if rect != None: self.drawnRects.append(rect)
+		
 	def drawBG(self):
-		self.context['surfDisp'].blit(self.imgBG, (0, 0))
+		"""
+			Draws the cached background layer. In dirty rect
+			mode only the areas drawn over last frame are
+			restored from it.
+		"""
+		layer = self.getBGLayer()
+		if self.context['dirtyRects'] == True and self.drawnRects != None:
+			for rect in self.drawnRects: self.context['surfDisp'].blit(layer, rect, rect)
+		else:
+			self.context['surfDisp'].blit(layer, (0, 0))
+		self.erasedRects = self.drawnRects
+		self.drawnRects = []
+	
+	def getPixelsPerSecond(self):
+		return float(self.context['layoutSize'][1] + self.IMG_ARROW_SIZE[1]) / float(self.ARROW_TIME_BOTTOM_TO_TOP)
+		
+	def getSpawnDistance(self):
+		return float(self.context['layoutSize'][1] - self.HUD_ARROW_START_POS[1])
+		
+	def isHoldNote(self, arrow):
+		return arrow[self.ARROW_TIMING_KEY_UP] - arrow[self.ARROW_TIMING_KEY_DOWN] >= self.HOLD_MIN_DURATION
+		
+	def loadHoldBodies(self):
+		"""
+			Builds the hold body textures, one per arrow type
+			and column, stretched from the middle row of the
+			arrow to the full layout height. Every hold is drawn
+			as the top part of its column's texture, so nothing
+			is built while playing.
+		"""
+		height = max(self.context['scaler'].toScreenLength(self.context['layoutSize'][1]), 1)
+		for arrowType in range(self.NUM_ARROW_TYPES):
+			for col in range(self.NUM_ARROW_DIRECTIONS):
+				img = self.imgArrows[arrowType][col][0]
+				row = img.subsurface((0, img.get_height() // 2, img.get_width(), 1))
+				body = pygame.transform.scale(row, (img.get_width(), height))
+				body.fill((255, 255, 255, self.HOLD_BODY_ALPHA), None, BLEND_RGBA_MULT)
+				self.holdBodies[(arrowType, col)] = body
+		
+	def drawHoldBody(self, sprite, arrowType, length, offset):
+		"""
+			Draws length layout pixels of body below the
+			sprite's center, clipped to the layout.
+		"""
+		top = sprite.pos[1] + offset[1] + (self.IMG_ARROW_SIZE[1] / 2)
+		if top < 0:
+			length = length + top
+			top = 0
+		length = min(length, self.context['layoutSize'][1] - top)
+		if length < 1: return None
+		
+		scaler = self.context['scaler']
+		body = self.holdBodies[(arrowType, sprite.data[self.ARROW_TIMING_KEY_KEY])]
+		body.set_alpha(sprite.alpha)
+		return self.context['surfDisp'].blit(
+			body, 
+			scaler.toScreen((sprite.pos[0] + offset[0], top)),
+			(0, 0, body.get_width(), min(max(scaler.toScreenLength(length), 1), body.get_height())))
+		
+	def drawLaneUnderlay(self, group):
+		"""
+			Draws the hold bodies of a lane under its arrow
+			heads. A held note's body shrinks as it's held.
+			The lane's group data is its player.
+		"""
+		player = group.data
+		rects = []
+		for sprite in group.sprites:
+			if sprite.terminated == True:
+				continue
+			elif sprite in player.activeHolds:
+				length = sprite.data[self.ARROW_TIMING_KEY_TAIL] - self.scrollDistance
+			elif self.isHoldNote(sprite.data):
+				length = sprite.data[self.ARROW_TIMING_KEY_TAIL] - sprite.data[self.ARROW_TIMING_KEY_HEAD]
+			else:
+				continue
+			rect = self.drawHoldBody(sprite, player.arrowType, length, group.offset)
+			if rect != None: rects.append(rect)
+		return rects
+		
+	def drawSparks(self, group):
+		return self.sparks.draw()
+		
+	def getBeatPhase(self, curLevelTime):
+		"""
+			How far through the current beat curLevelTime is,
+			from 0 up to 1.
+		"""
+		interval = self.beats[self.curBeat] - self.lastBeatTime
+		if interval <= 0: return 0.0
+		return ((curLevelTime - self.lastBeatTime) / interval) % 1.0
+		
+	def skinLanes(self, player):
+		"""
+			Skins each of the player's lanes with its arrow
+			type's image for the current beat, so every note
+			in a lane pulses together without touching the
+			notes themselves.
+		"""
 		for i in range(self.NUM_ARROW_DIRECTIONS):
-			self.context['surfDisp'].blit(
-				self.imgHUDArrows[i], 
-				(self.getColPosX(i), self.HUD_ARROW_START_POS[1]))
-		for flash in self.hudArrowFlashers: flash.draw()
-	
-	def drawSprites(self):
-		for sprite in self.sprites: sprite.draw()
-		
-	def spriteAddBeat(self, sprite):
-		interval = float(self.beats[self.curBeat] - self.lastBeatTime) / float(self.NUM_ARROW_STATES)
-		nextBeatTime = self.context['timeLevelStart'] + self.beats[self.curBeat]
-		for i in range(self.NUM_ARROW_STATES):
-			sprite.queueAction(	
-				{	
-					BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_SET_IMAGE,
-					BPSprite.ACTION_SET_IMAGE_INDEX:self.NUM_ARROW_STATES - i - 1,
-					BPSprite.ACTION_START_TIME:nextBeatTime - (i * interval),
-					BPSprite.ACTION_BLEND:True
-				})
-		sprite.queueAction(	# Callback and do it again
-			{	
-				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_CALLBACK,
-				BPSprite.ACTION_CALLBACK_FUNCTION:self.spriteAddBeat,
-				BPSprite.ACTION_START_TIME:nextBeatTime,
-				BPSprite.ACTION_BLEND:True
-			})
-			
-	def hudArrowAddFlash(self, sprite):
-		startTime = time.time()
-		endTime = startTime + (float(self.beats[self.curBeat] - self.lastBeatTime) / float(self.NUM_ARROW_STATES))
-		cbTime = self.context['timeLevelStart'] + self.beats[self.curBeat]
-		sprite.queueAction(	# Flash on
-			{	
-				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_ALPHA,
-				BPSprite.ACTION_ALPHA_TARGET:255,
-				BPSprite.ACTION_ALPHA_ORIGIN:0,
-				BPSprite.ACTION_START_TIME:startTime,
-				BPSprite.ACTION_BLEND:True
-			})
-		sprite.queueAction(	# Flash off
-			{	
-				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_ALPHA,
-				BPSprite.ACTION_ALPHA_TARGET:0,
-				BPSprite.ACTION_ALPHA_ORIGIN:255,
-				BPSprite.ACTION_START_TIME:endTime,
-				BPSprite.ACTION_BLEND:True
-			})
-		sprite.queueAction(	# Callback and do it again
-			{	
-				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_CALLBACK,
-				BPSprite.ACTION_CALLBACK_FUNCTION:self.hudArrowAddFlash,
-				BPSprite.ACTION_START_TIME:cbTime,
-				BPSprite.ACTION_BLEND:True
-			})
+			player.laneGroups[i].skin = self.imgArrows[player.arrowType][i][self.beatImg:self.beatImg + 1]
 			
-	def removeSprite(self, sprite):
-		self.sprites.remove(sprite)
+	def drawCombo(self, group):
+		stats = group.data.stats
+		if stats.combo < self.COMBO_MIN_DISPLAY: return []
 		
-	def removeFlasher(self, sprite):
-		self.flashers.remove(sprite)
+		surf = self.context['surfDisp']
+		scaler = self.context['scaler']
+		centerX = scaler.toScreen(((float(self.context['layoutSize'][0]) / float(2)) + group.offset[0], 0))[0]
+		digits = self.comboDigits.render(stats.combo)
+		return [
+			surf.blit(digits, (centerX - (digits.get_width() / 2), scaler.toScreen((0, self.COMBO_DIGITS_Y))[1])),
+			surf.blit(self.imgComboText, (centerX - (self.imgComboText.get_width() / 2), scaler.toScreen((0, self.COMBO_TEXT_Y))[1]))]
 		
-	def drawHUD(self):
-		for digit in self.scoreDigits: digit.draw()
-		for flasher in self.flashers: flasher.draw()
+	def createScene(self):
+		"""
+			Builds the scene graph. Each player gets its own
+			HUD arrow flashes, one group per lane (skinned with
+			its arrow type), score, combo and hit/miss flashers,
+			all moved by the player's offset. Groups of the
+			same kind share a z, so fields draw side by side in
+			the same passes. Sparks are one system for all.
+		"""
+		self.scene = BPScene()
+		for player in self.players:
+			player.hudFlashGroup = self.scene.addGroup(BPSpriteGroup(self.context, self.Z_HUD_FLASH))
+			for i in range(self.NUM_ARROW_DIRECTIONS):
+				lane = BPSpriteGroup(
+					self.context, 
+					self.Z_LANES, 
+					(self.getColPosX(i), 0, self.IMG_ARROW_SIZE[0], self.context['layoutSize'][1]),
+					self.drawLaneUnderlay,
+					player)
+				player.laneGroups.append(self.scene.addGroup(lane))
+			self.skinLanes(player)
+			player.scoreGroup = self.scene.addGroup(BPSpriteGroup(self.context, self.Z_SCORE))
+			player.comboGroup = self.scene.addGroup(BPSpriteGroup(self.context, self.Z_COMBO, None, self.drawCombo, player))
+			player.flasherGroup = self.scene.addGroup(BPSpriteGroup(self.context, self.Z_FLASHERS))
+			for group in [player.hudFlashGroup, player.scoreGroup, player.comboGroup, player.flasherGroup] + player.laneGroups:
+				group.offset = player.offset
+		self.sparkGroup = self.scene.addGroup(BPSpriteGroup(self.context, self.Z_SPARKS, None, self.drawSparks))
 
 	def start(self):
 		# Level data
-		self.context['level'] = 0
+		library = self.context['library']
+		if 'level' not in self.context: self.context['level'] = library.getLevels()[0]
 		level = self.context['level']
-		self.timingFile = 'timing_%d.txt' % level
-		self.beatFile = 'beats_%d.txt' % level
-		self.bgFile = 'bg_%d.png' % level
-		self.songFile = 'song_%d.ogg' % level
+		song = library.getSong(level)
+		self.timingFile = song[library.SONG_KEY_TIMING_FILE]
+		self.beatFile = song[library.SONG_KEY_BEAT_FILE]
+		self.bgFile = song[library.SONG_KEY_BG_FILE]
+		self.songFile = song[library.SONG_KEY_SONG_FILE]
 		
-		# Load the arrow timing data
+		# Load the arrow timing data and place it on the note field. A
+		# compiled chart (see BPChartCompiler) already has the notes
+		# sorted, the beats parsed, and the spawn times for 1x speed.
+		pixelsPerSecond = self.getPixelsPerSecond() * self.context['scrollSpeed']
+		spawnDistance = self.getSpawnDistance()
+		self.noteField = BPNoteField(
+			self.getPixelsPerSecond(), self.context['scrollSpeed'], library.loadSpeedChanges(level))
+		compiled = library.loadCompiledChart(level)
+		spawns = None
+		if compiled != None:
+			notes = compiled.getNotes()
+			self.beats = list(compiled.beats)
+			if compiled.pixelsPerSecond == pixelsPerSecond and compiled.spawnDistance == spawnDistance:
+				spawns = compiled.spawns
+		else:
+			notes = library.loadChart(level)
+			self.beats = library.loadBeats(level)
+			
 		timingKeys = [self.ARROW_TIMING_KEY_DOWN, self.ARROW_TIMING_KEY_UP, self.ARROW_TIMING_KEY_KEY]
-		with open(self.timingFile, 'r') as f:
-			for line in f:
-				timingValues = line.split('\t')
-				timingValues = [float(i) for i in timingValues]
-				arrow = dict(zip(timingKeys, timingValues))
-				arrow[self.ARROW_TIMING_KEY_KEY] = int(arrow[self.ARROW_TIMING_KEY_KEY])
-				self.arrowData.append(arrow)
-				
-		# Load the beat timings
-		with open(self.beatFile, 'r') as f:
-			for line in f:
-				self.beats.append(float(line.split('\t')[0]))
+		for i in range(len(notes)):
+			arrow = dict(zip(timingKeys, notes[i]))
+			arrow[self.ARROW_TIMING_KEY_HEAD] = self.noteField.getDistance(arrow[self.ARROW_TIMING_KEY_DOWN])
+			arrow[self.ARROW_TIMING_KEY_TAIL] = self.noteField.getDistance(arrow[self.ARROW_TIMING_KEY_UP])
+			if spawns != None:
+				arrow[self.ARROW_TIMING_KEY_SPAWN] = spawns[i]
+			else:
+				arrow[self.ARROW_TIMING_KEY_SPAWN] = self.noteField.getTime(arrow[self.ARROW_TIMING_KEY_HEAD] - spawnDistance)
+			self.arrowData.append(arrow)
+		if compiled == None: self.arrowData.sort(key = lambda arrow: arrow[self.ARROW_TIMING_KEY_SPAWN])
+		for i in range(len(self.arrowData)): self.arrowData[i][self.ARROW_TIMING_KEY_INDEX] = i
 						
 		# Load the images
-		self.imgBG = pygame.image.load(self.bgFile).convert()	
-		self.imgHitFlasher = pygame.image.load('hit.png').convert_alpha()
-		self.imgMissFlasher = pygame.image.load('text_flasher_miss.png').convert_alpha()
+		scaler = self.context['scaler']
+		self.imgBG = scaler.load(self.bgFile, self.context['windowSize']).convert()
+		self.imgHitFlasher = scaler.load('hit.png').convert_alpha()
+		self.imgMissFlasher = scaler.load('text_flasher_miss.png').convert_alpha()
+		self.imgComboText = scaler.load('text_flasher_combo.png').convert_alpha()
 		for i in range(self.NUM_ARROW_DIRECTIONS):	# HUD arrows
-			self.imgHUDArrows.append(pygame.image.load('arrow_hud_%d.png' % (i)).convert_alpha())	
-			self.imgHUDArrowFlashers.append(pygame.image.load('arrow_hud_flash_%d.png' % (i)).convert_alpha())	
+			self.imgHUDArrows.append(scaler.load('arrow_hud_%d.png' % (i)).convert_alpha())	
+			self.imgHUDArrowFlashers.append(scaler.load('arrow_hud_flash_%d.png' % (i)).convert_alpha())	
 		for i in range(self.NUM_HIT_TEXT_FLASHERS): # Hit text flashers
-			self.imgTextFlashers.append(pygame.image.load('text_flasher_%d.png' % (i)).convert_alpha())
+			self.imgTextFlashers.append(scaler.load('text_flasher_%d.png' % (i)).convert_alpha())
 		for i in range(10): 		# Score digits
-			self.imgScoreNums.append(pygame.image.load('num_%d.png' % (i)).convert_alpha())
+			self.imgScoreNums.append(scaler.load('num_%d.png' % (i)).convert_alpha())
+		self.comboDigits = BPDigitStrip(self.imgScoreNums)
+		sparkSize = max(scaler.toScreenLength(self.SPARK_SIZE), 1)
+		self.sparks = BPParticleSystem(self.context, scaler.load('spark.jpg', (sparkSize, sparkSize)), self.SPARK_BUDGET)
+		font = pygame.font.Font(None, scaler.toScreenLength(self.PAUSED_FONT_SIZE))
+		self.imgPaused = font.render('Paused', True, self.PAUSED_COLOR)
 		for i in range(self.NUM_ARROW_TYPES):		# Gameplay arrows
 			self.imgArrows.append([])
 			for j in range(self.NUM_ARROW_DIRECTIONS):
 				self.imgArrows[i].append([])
 				for k in range(self.NUM_ARROW_STATES):
 					self.imgArrows[i][j].append(
-						pygame.image.load('arrow_%d_%d_%d.png' % (i, j, k)).convert_alpha())
+						scaler.load('arrow_%d_%d_%d.png' % (i, j, k)).convert_alpha())
+		self.loadHoldBodies()
 		
 		# Start the music
 		self.context['musicObj'] = pygame.mixer.Sound(self.songFile)
+		self.songLength = self.context['musicObj'].get_length()
 		if self.context['musicEnabled'] == True:
-			self.context['musicObj'].play()
-		self.context['timeLevelStart'] = time.time()
+			self.musicChannel = self.context['musicObj'].play()
+		self.context['timeLevelStart'] = time.time() + self.context['globalOffset']	# Calibrated level clock
+		self.timePlayed = time.time()		# When the play started, for the leaderboard
 			
-		# Create the score digit sprites
-		self.spawnScoreDigits()
-		
-		# Create the hud arrow flashers
-		for i in range(self.NUM_ARROW_DIRECTIONS):
-			sprite = BPSprite(
-				self.context, 
-				"hud_arrow_flasher",
-				(self.getColPosX(i), self.HUD_ARROW_START_POS[1]),
-				[self.imgHUDArrowFlashers[i]])
-			sprite.alpha = 0
-			self.hudArrowAddFlash(sprite)
-			self.hudArrowFlashers.append(sprite)
+		# The players, their fields spread evenly across the layout
+		numPlayers = self.context['numPlayers']
+		for i in range(numPlayers):
+			fieldX = (float(self.context['layoutSize'][0]) * (i + 0.5) / float(numPlayers)) - (float(self.context['layoutSize'][0]) / float(2))
+			player = BPPlayer(i, self.PLAYER_KEYS[i], (fieldX, 0), self.NUM_ARROW_DIRECTIONS, self.spawnMissFlasher)
+			player.stats = BPJudgementStats(len(self.HIT_THRESHOLDS), self.HIT_THRESHOLDS[-1], self.HISTOGRAM_BINS)
+			for j in range(self.NUM_ARROW_DIRECTIONS): self.keyMap[player.keys[j]] = (player, j)
+			self.players.append(player)
+		for i in range(min(pygame.joystick.get_count(), numPlayers)):
+			pad = pygame.joystick.Joystick(i)
+			self.pads.append(pad)
+			self.padMap[pad.get_instance_id()] = self.players[i]
+			
+		# Create the scene, the score digit sprites and the hud arrow
+		# flashers (shown on the beat, see positionArrows)
+		self.createScene()
+		for player in self.players:
+			self.spawnScoreDigits(player)
+			for i in range(self.NUM_ARROW_DIRECTIONS):
+				sprite = BPSprite(
+					self.context, 
+					"hud_arrow_flasher",
+					(self.getColPosX(i), self.HUD_ARROW_START_POS[1]),
+					[self.imgHUDArrowFlashers[i]])
+				player.hudFlashGroup.add(sprite)
 
-		self.keystrokes = []
+		# Start a recording session
+		if self.RECORDING_MODE == True:
+			self.openPresses = [None] * self.NUM_ARROW_DIRECTIONS
+			self.recordedNotes = collections.deque()
+			self.chartWriter = BPChartWriter(
+				os.path.join(library.songsDir, self.RECORDING_TEXT_FILE % level),
+				os.path.join(library.songsDir, self.RECORDING_BINARY_FILE % level),
+				self.RECORDING_BATCH_SIZE)
 		
-	def arrowMissDelegate(self, sprite):
-		self.sprites.remove(sprite)
-		self.spawnMissFlasher()
+	def getResult(self, player):
+		"""
+			The player's play so far as a leaderboard row
+			(see BPLeaderboard.RESULT_KEY_*).
+		"""
+		library = self.context['library']
+		result = {
+			BPLeaderboard.RESULT_KEY_HASH:library.getSong(self.context['level'])[library.SONG_KEY_HASH],
+			BPLeaderboard.RESULT_KEY_LEVEL:self.context['level'],
+			BPLeaderboard.RESULT_KEY_PLAYER:self.context['playerNames'][player.index],
+			BPLeaderboard.RESULT_KEY_SCORE:player.score,
+			BPLeaderboard.RESULT_KEY_MAX_COMBO:player.stats.maxCombo,
+			BPLeaderboard.RESULT_KEY_MISS:player.stats.misses,
+			BPLeaderboard.RESULT_KEY_DROP:player.stats.drops,
+			BPLeaderboard.RESULT_KEY_MEAN_OFFSET:player.stats.meanOffset,
+			BPLeaderboard.RESULT_KEY_PLAYED:self.timePlayed
+		}
+		for i in range(len(BPLeaderboard.TIER_KEYS)):
+			result[BPLeaderboard.TIER_KEYS[i]] = player.stats.tierCounts[i]
+		return result
+		
+	def isSongOver(self, curLevelTime):
+		"""
+			True once every note has been spawned and judged
+			for every player, no hold is still down, and the
+			audio has played out, plus END_DELAY for the last
+			flashers to fade.
+		"""
+		if self.nextArrow < len(self.arrowData): return False
+		for player in self.players:
+			if len(player.sprites) > 0: return False
+			if player.activeHolds.count(None) < len(player.activeHolds): return False
+		return curLevelTime >= self.songLength + self.END_DELAY
 		
-	def spawnScoreDigits(self):
-		cx = self.context['windowSize'][0] - self.SCORE_DIGIT_OFFSET[0]
+	def finish(self):
+		"""
+			Hands the play to the results screen, one result
+			and one set of stats per player.
+		"""
+		self.context['musicObj'].stop()
+		self.context['results'] = [self.getResult(player) for player in self.players]
+		self.context['stats'] = [player.stats for player in self.players]
+		self.exit()
+		
+	def spawnScoreDigits(self, player):
+		"""
+			Score digits go in the top right with one player,
+			and centered under each field with more.
+		"""
+		cx = self.context['layoutSize'][0] - self.SCORE_DIGIT_OFFSET[0]
+		y = self.SCORE_DIGIT_OFFSET[1]
+		if len(self.players) > 1:
+			cx = (float(self.context['layoutSize'][0]) / float(2)) + (float(self.NUM_SCORE_DIGITS * self.SCORE_DIGIT_SIZE[0]) / float(2))
+			y = self.MULTI_SCORE_Y
 		for i in range(self.NUM_SCORE_DIGITS):
 			cx = cx - self.SCORE_DIGIT_SIZE[0]
 			sprite = BPSprite(
 				self.context, 
 				None,
-				(cx, self.SCORE_DIGIT_OFFSET[1]),
+				(cx, y),
 				self.imgScoreNums)
-			self.scoreDigits.append(sprite)
+			player.scoreGroup.add(sprite)
 			cx = cx - self.SCORE_DIGIT_PAD
 		
 	def spawnArrows(self):
-		imgHeight = self.IMG_ARROW_SIZE[1]
-		windowHeight = self.context['windowSize'][1]
-		pixelsPerSecond =  float(windowHeight + imgHeight) / float(self.ARROW_TIME_BOTTOM_TO_TOP)
-		secondsPerPixel = float(1) / float(pixelsPerSecond)
-		pixelsToHitZone = windowHeight - self.HUD_ARROW_START_POS[1]
-		timeToHitZone = pixelsToHitZone * secondsPerPixel
+		"""
+			Spawns the arrows whose spawn time has come, one
+			sprite per player. arrowData is sorted by spawn
+			time, so this only looks at arrows from nextArrow
+			on, and the cursor is shared by every player.
+		"""
 		curLevelTime = time.time() - self.context['timeLevelStart']
-		unspawned = []
-		
-		for arrow in self.arrowData:	# check for arrows to spawn
-			keyTime = arrow[self.ARROW_TIMING_KEY_DOWN]
-			spawnTime = keyTime - timeToHitZone
-			if curLevelTime >= spawnTime:	# if it's time to spawn this arrow
-				curKey = arrow[self.ARROW_TIMING_KEY_KEY]
-				colPosX = self.getColPosX(curKey)
-				timeAdjustment = curLevelTime - spawnTime
-				duration = self.ARROW_TIME_BOTTOM_TO_TOP - timeAdjustment
-				startY = windowHeight - (pixelsPerSecond * timeAdjustment)
-				timeSinceLastBeat = curLevelTime - self.lastBeatTime
-				timeBetweenBeats = self.beats[self.curBeat] - self.lastBeatTime
-				curImg = (math.floor(float(timeSinceLastBeat) / (float(timeBetweenBeats) / float(self.NUM_ARROW_STATES))) + 1) % self.NUM_ARROW_STATES
-				arrowSprite = BPSprite(
-					self.context, 
-					arrow,
-					(colPosX, startY),
-					self.imgArrows[self.arrowType][curKey], 
-					curImg)
-				arrowSprite.queueAction(	# Animate past top of screen
-					{	
-						BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_POSITION,
-						BPSprite.ACTION_POSITION_TARGET:(colPosX, -1 * imgHeight),
-						BPSprite.ACTION_DURATION:duration
-					})
-				arrowSprite.queueAction(	# Fade past hit zone
-					{	
-						BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_ALPHA,
-						BPSprite.ACTION_ALPHA_TARGET:0,
-						BPSprite.ACTION_START_TIME:time.time() + timeToHitZone,
-						BPSprite.ACTION_DURATION:self.ARROW_FADE_TIME,
-						BPSprite.ACTION_BLEND:True
-					})
-				arrowSprite.queueAction(	# Callback to controller on miss
-					{	
-						BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_CALLBACK,
-						BPSprite.ACTION_CALLBACK_FUNCTION:self.arrowMissDelegate,
-						BPSprite.ACTION_START_TIME:time.time() + timeToHitZone + self.HIT_THRESHOLDS[2],
-						BPSprite.ACTION_BLEND:True
-					})
-				arrowSprite.queueAction(	# Terminate
-					{
-						BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_TERMINATE,
-						BPSprite.ACTION_TERMINATE_DELEGATE:self.removeSprite,
-						BPSprite.ACTION_START_TIME:time.time() + duration
-					})
-				self.spriteAddBeat(arrowSprite)
-				self.sprites.append(arrowSprite)
-			else:
-				unspawned.append(arrow)
-		self.arrowData = unspawned
+		while self.nextArrow < len(self.arrowData):	# check for arrows to spawn
+			arrow = self.arrowData[self.nextArrow]
+			if curLevelTime < arrow[self.ARROW_TIMING_KEY_SPAWN]: break
+			self.nextArrow = self.nextArrow + 1
+			for player in self.players:
+				player.sprites.append(self.spawnArrow(player, arrow))
+			
+	def spawnArrow(self, player, arrow):
+		"""
+			Creates an arrow's sprite in the player's lane,
+			with its fade, miss and exit actions, and returns
+			it.
+		"""
+		exitDistance = self.HUD_ARROW_START_POS[1] + self.IMG_ARROW_SIZE[1]	# hit zone to past the top
+		curKey = arrow[self.ARROW_TIMING_KEY_KEY]
+		keyTime = self.context['timeLevelStart'] + arrow[self.ARROW_TIMING_KEY_DOWN]
+		tailDistance = arrow[self.ARROW_TIMING_KEY_HEAD]
+		if self.isHoldNote(arrow):	# keep going until the tail is off screen
+			tailDistance = arrow[self.ARROW_TIMING_KEY_TAIL]
+		exitTime = self.context['timeLevelStart'] + self.noteField.getTime(tailDistance + exitDistance)
+		arrowSprite = BPSprite(
+			self.context, 
+			arrow,
+			(self.getColPosX(curKey), self.context['layoutSize'][1]),	# placed by positionArrows
+			player.laneGroups[curKey].skin)		# pulses with the lane skin (see skinLanes)
+		arrowSprite.queueAction(	# Fade past hit zone
+			{	
+				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_ALPHA,
+				BPSprite.ACTION_ALPHA_TARGET:0,
+				BPSprite.ACTION_START_TIME:keyTime,
+				BPSprite.ACTION_DURATION:self.ARROW_FADE_TIME,
+				BPSprite.ACTION_BLEND:True
+			})
+		arrowSprite.queueAction(	# Callback to the player on miss
+			{	
+				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_CALLBACK,
+				BPSprite.ACTION_CALLBACK_FUNCTION:player.arrowMissDelegate,
+				BPSprite.ACTION_START_TIME:keyTime + self.HIT_THRESHOLDS[2],
+				BPSprite.ACTION_BLEND:True
+			})
+		arrowSprite.queueAction(	# Terminate
+			{
+				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_TERMINATE,
+				BPSprite.ACTION_TERMINATE_DELEGATE:player.removeSprite,
+				BPSprite.ACTION_START_TIME:exitTime
+			})
+		player.laneGroups[curKey].add(arrowSprite)
+		return arrowSprite
+		
+	def positionArrows(self):
+		"""
+			Moves every scrolling arrow to its place on the
+			note field and the lanes to the image for the
+			current beat. The scroll distance and beat phase
+			are looked up once per frame for all players; each
+			arrow is then one subtraction. Arrows are placed for
+			when the frame will be on screen, presentLatency
+			(see BPDisplay) from now.
+		"""
+		curLevelTime = time.time() + self.context['presentLatency'] - self.context['timeLevelStart']
+		self.scrollDistance = self.noteField.getDistance(curLevelTime)
+		phase = self.getBeatPhase(curLevelTime)
+		beatImg = (int(phase * self.NUM_ARROW_STATES) + self.NUM_ARROW_STATES - 1) % self.NUM_ARROW_STATES
+		reskin = beatImg != self.beatImg
+		self.beatImg = beatImg
+		flash = phase < 1.0 / float(self.NUM_ARROW_STATES)		# HUD arrows flash on the beat
+		hitY = self.HUD_ARROW_START_POS[1] - self.scrollDistance
+		for player in self.players:
+			if reskin == True: self.skinLanes(player)
+			player.hudFlashGroup.visible = flash
+			for lane in player.laneGroups:
+				for sprite in lane.sprites:
+					if sprite.terminated == True or sprite in player.activeHolds: continue
+					sprite.pos = (sprite.pos[0], hitY + sprite.data[self.ARROW_TIMING_KEY_HEAD])
 		
-	def spawnHitFlasher(self, col, txtIdx):
+	def spawnHitFlasher(self, player, col, txtIdx):
 		# kill any miss flashers
-		self.flashers = [f for f in self.flashers if f.data != self.MISS_FLASHER_INDICATOR]
+		for flasher in player.flasherGroup.sprites:
+			if flasher.data == self.MISS_FLASHER_INDICATOR: player.flasherGroup.retire(flasher)
 			
-		# spark sprite
+		# hit flash sprite
 		sprite = BPSprite(
 			self.context, 
 			None,
@@ -599,10 +3276,17 @@ class BPGameplayController(BPController):
 		sprite.queueAction(	# Terminate
 			{
 				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_TERMINATE,
-				BPSprite.ACTION_TERMINATE_DELEGATE:self.removeFlasher,
+				BPSprite.ACTION_TERMINATE_DELEGATE:player.removeFlasher,
 				BPSprite.ACTION_START_TIME:time.time() + self.HIT_FLASHER_FADE_TIME
 			})
-		self.flashers.append(sprite)
+		player.flasherGroup.add(sprite)
+		
+		# spark particles (shared by all fields, so placed with the field's offset)
+		self.sparks.emit(
+			(self.getColPosX(col) + (self.IMG_ARROW_SIZE[0] / 2) + player.offset[0], self.HUD_ARROW_START_POS[1] + (self.IMG_ARROW_SIZE[1] / 2) + player.offset[1]),
+			self.SPARK_COUNTS[min(txtIdx, len(self.SPARK_COUNTS) - 1)], 
+			self.SPARK_SPEED, 
+			self.SPARK_LIFE)
 		
 		# text sprite
 		xOffset = float(self.IMG_ARROW_SIZE[0] - self.HIT_TEXT_FLASHER_SIZE[0]) / float(2)
@@ -617,121 +3301,491 @@ class BPGameplayController(BPController):
 				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_ALPHA,
 				BPSprite.ACTION_ALPHA_TARGET:0,
 				BPSprite.ACTION_START_TIME:time.time(),
-				BPSprite.ACTION_DURATION:self.HIT_FLASHER_FADE_TIME
+				BPSprite.ACTION_DURATION:self.HIT_FLASHER_FADE_TIME,
+				BPSprite.ACTION_EASING:BPEasing.EASE_IN_QUAD
 			})
 		txtSprite.queueAction(	# Terminate
 			{
 				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_TERMINATE,
-				BPSprite.ACTION_TERMINATE_DELEGATE:self.removeFlasher,
+				BPSprite.ACTION_TERMINATE_DELEGATE:player.removeFlasher,
 				BPSprite.ACTION_START_TIME:time.time() + self.HIT_FLASHER_FADE_TIME
 			})
-		self.flashers.append(txtSprite)
+		player.flasherGroup.add(txtSprite)
 		
-	def spawnMissFlasher(self):
+	def spawnMissFlasher(self, player):
 		sprite = BPSprite(
 			self.context, 
 			self.MISS_FLASHER_INDICATOR,
-			((float(self.context['windowSize'][0]) / float(2)) - (float(self.MISS_FLASHER_SIZE[0]) / float(2)), self.MISS_FLASHER_Y),
+			((float(self.context['layoutSize'][0]) / float(2)) - (float(self.MISS_FLASHER_SIZE[0]) / float(2)), self.MISS_FLASHER_Y),
 			[self.imgMissFlasher])
 		sprite.queueAction(	# Fade 
 			{	
 				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_ALPHA,
 				BPSprite.ACTION_ALPHA_TARGET:0,
 				BPSprite.ACTION_START_TIME:time.time(),
-				BPSprite.ACTION_DURATION:self.MISS_FLASHER_FADE_TIME
+				BPSprite.ACTION_DURATION:self.MISS_FLASHER_FADE_TIME,
+				BPSprite.ACTION_EASING:BPEasing.EASE_IN_QUAD	# Stay readable, then drop off
 			})
 		sprite.queueAction(	# Terminate
 			{
 				BPSprite.ACTION_IDENTIFIER:BPSprite.ACTION_TERMINATE,
-				BPSprite.ACTION_TERMINATE_DELEGATE:self.removeFlasher,
+				BPSprite.ACTION_TERMINATE_DELEGATE:player.removeFlasher,
 				BPSprite.ACTION_START_TIME:time.time() + self.MISS_FLASHER_FADE_TIME
 			})
-		self.flashers.append(sprite)
+		player.flasherGroup.add(sprite)
 		
-	def updateScoreDigitSprites(self):
-		for i in range(len(self.scoreDigits)):
-			self.scoreDigits[i].curImg = int(str(self.score).zfill(self.NUM_SCORE_DIGITS)[-1 * (i + 1)])
+	def updateScoreDigitSprites(self, player):
+		scoreDigits = player.scoreGroup.sprites
+		for i in range(len(scoreDigits)):
+			scoreDigits[i].curImg = int(str(player.score).zfill(self.NUM_SCORE_DIGITS)[-1 * (i + 1)])
 			
-	def updateArrowTypes(self):
-		self.arrowType = (self.arrowType + 1) % self.NUM_ARROW_TYPES
-		for sprite in self.sprites:
-			sprite.imgObj = self.imgArrows[self.arrowType][sprite.data[self.ARROW_TIMING_KEY_KEY]]
+	def updateArrowTypes(self, player):
+		player.arrowType = (player.arrowType + 1) % self.NUM_ARROW_TYPES
+		self.skinLanes(player)
+			
+	def addScore(self, player, value):
+		player.score = min(player.score + value, (10 ** self.NUM_SCORE_DIGITS) - 1)
 		
-	def handleUpdate(self):
-		if self.RECORDING_MODE == True: return
+	def startHold(self, player, sprite, col, curLevelTime):
+		"""
+			Pins a hit hold note's head to the HUD arrow. The
+			body shrinks into it until the note is released.
+		"""
+		sprite.actions = []
+		sprite.alpha = 255
+		sprite.pos = (self.getColPosX(col), self.HUD_ARROW_START_POS[1])
+		player.activeHolds[col] = sprite
+		player.nextHoldTicks[col] = curLevelTime + self.HOLD_TICK_TIME
+		
+	def releaseHold(self, player, col, curLevelTime):
+		"""
+			Judges a hold note on release. Letting go within
+			the widest hit threshold of the note's up time
+			counts as holding it through.
+		"""
+		sprite = player.activeHolds[col]
+		player.activeHolds[col] = None
+		player.laneGroups[col].retire(sprite)
+		if sprite.data[self.ARROW_TIMING_KEY_UP] - curLevelTime <= self.HIT_THRESHOLDS[-1]:
+			self.addScore(player, self.SCORE_VALUES[0])
+			self.spawnHitFlasher(player, col, 0)
+		else:
+			player.stats.addDrop()
+			self.spawnMissFlasher(player)
+			
+	def simulateHolds(self, curLevelTime):
+		for player in self.players:
+			for col in range(self.NUM_ARROW_DIRECTIONS):
+				sprite = player.activeHolds[col]
+				if sprite == None: continue
+				
+				# Sustained score while the note is held
+				endTime = min(curLevelTime, sprite.data[self.ARROW_TIMING_KEY_UP])
+				while player.nextHoldTicks[col] <= endTime:
+					self.addScore(player, self.SCORE_HOLD_TICK)
+					player.nextHoldTicks[col] = player.nextHoldTicks[col] + self.HOLD_TICK_TIME
+					
+				if curLevelTime >= sprite.data[self.ARROW_TIMING_KEY_UP]:
+					self.releaseHold(player, col, curLevelTime)
+					
+	def pause(self):
+		self.paused = True
+		self.timePaused = time.time()
+		if self.musicChannel != None: self.musicChannel.pause()
+		
+	def resume(self):
+		"""
+			Picks up where pause() left off. The level clock,
+			every queued sprite action and the sparks are moved
+			on by the time spent paused, so nothing jumps. Key
+			releases aren't seen while paused, so held notes
+			whose key was let go are released now.
+		"""
+		delta = time.time() - self.timePaused
+		self.context['timeLevelStart'] = self.context['timeLevelStart'] + delta
+		self.scene.shiftTime(delta)
+		self.sparks.shiftTime(delta)
+		self.paused = False
+		curLevelTime = time.time() - self.context['timeLevelStart']
+		for player in self.players:
+			for col in range(self.NUM_ARROW_DIRECTIONS):
+				if player.activeHolds[col] != None and self.isColumnDown(player, col) == False:
+					self.releaseHold(player, col, curLevelTime)
+		if self.musicChannel != None: self.musicChannel.unpause()
+		
+	def playMusicFrom(self, levelTime):
+		"""
+			Restarts the song so level time levelTime is now.
+			The song's samples are fetched once and the clip is
+			cut from them, as pygame can't seek a Sound.
+		"""
+		if self.songRaw == None: self.songRaw = memoryview(self.context['musicObj'].get_raw())	# Sliced without copying
+		frequency, size, channels = pygame.mixer.get_init()
+		frameBytes = channels * abs(size) // 8
+		offset = int(max(levelTime + self.context['globalOffset'], 0) * frequency) * frameBytes
+		self.context['musicObj'].stop()
+		self.context['musicObj'] = pygame.mixer.Sound(buffer = self.songRaw[offset:])
+		self.musicChannel = None
+		if self.context['musicEnabled'] == True:
+			self.musicChannel = self.context['musicObj'].play()
+		self.context['timeLevelStart'] = time.time() - levelTime
+		
+	def takeSnapshot(self, curLevelTime):
+		snapshot = BPPlaySnapshot(curLevelTime)
+		snapshot.nextArrow = self.nextArrow
+		snapshot.curBeat = self.curBeat
+		snapshot.lastBeatTime = self.lastBeatTime
+		for player in self.players:
+			snapshot.live.append(array.array('i', [sprite.data[self.ARROW_TIMING_KEY_INDEX] for sprite in player.sprites if sprite.terminated == False]))
+			snapshot.holds.append(array.array('i', [-1 if sprite == None else sprite.data[self.ARROW_TIMING_KEY_INDEX] for sprite in player.activeHolds]))
+			snapshot.holdTicks.append(array.array('d', player.nextHoldTicks))
+			snapshot.scores.append(player.score)
+			snapshot.arrowTypes.append(player.arrowType)
+			snapshot.stats.append(player.stats.toArray())
+		self.snapshots.append(snapshot)
+		
+	def restoreSnapshot(self, snapshot):
+		"""
+			Puts the play back to a snapshot: the notes on
+			screen are rebuilt from their arrowData indexes, and
+			the clock and audio jump back to its level time.
+			A held note stays held only if its key still is;
+			otherwise it comes back as an unhit note.
+		"""
+		self.sparks.clear()
+		self.playMusicFrom(snapshot.levelTime)
+		self.nextArrow = snapshot.nextArrow
+		self.curBeat = snapshot.curBeat
+		self.lastBeatTime = snapshot.lastBeatTime
+		for player in self.players:
+			for lane in player.laneGroups:
+				for sprite in lane.sprites:
+					if sprite.terminated == False: lane.retire(sprite)
+			for flasher in player.flasherGroup.sprites:
+				if flasher.terminated == False: player.flasherGroup.retire(flasher)
+			player.sprites.clear()
+			player.activeHolds = [None] * self.NUM_ARROW_DIRECTIONS
+			
+			player.score = snapshot.scores[player.index]
+			player.arrowType = snapshot.arrowTypes[player.index]
+			player.stats.fromArray(snapshot.stats[player.index])
+			self.skinLanes(player)
+			holds = snapshot.holds[player.index]
+			live = list(snapshot.live[player.index])
+			for col in range(self.NUM_ARROW_DIRECTIONS):
+				if holds[col] >= 0 and self.isColumnDown(player, col) == False: live.append(holds[col])
+			for index in sorted(live):		# judgement order
+				player.sprites.append(self.spawnArrow(player, self.arrowData[index]))
+			for col in range(self.NUM_ARROW_DIRECTIONS):
+				if holds[col] >= 0 and self.isColumnDown(player, col) == True:
+					self.startHold(player, self.spawnArrow(player, self.arrowData[holds[col]]), col, snapshot.levelTime)
+			player.nextHoldTicks = list(snapshot.holdTicks[player.index])
+		self.positionArrows()
+		self.nextSnapshotTime = snapshot.levelTime + self.SNAPSHOT_INTERVAL
+		
+	def rewind(self):
+		"""
+			Goes back to the newest snapshot at least
+			REWIND_TIME old (or the oldest one kept). Newer
+			snapshots are dropped. A paused play stays paused.
+		"""
+		if len(self.snapshots) == 0: return
+		curLevelTime = time.time() - self.context['timeLevelStart']
+		if self.paused == True: curLevelTime = self.timePaused - self.context['timeLevelStart']
+		while len(self.snapshots) > 1 and self.snapshots[-1].levelTime > curLevelTime - self.REWIND_TIME:
+			self.snapshots.pop()
+		self.restoreSnapshot(self.snapshots[-1])
+		if self.paused == True: self.pause()
+		
+	def handleSimulate(self, simTime):
+		if self.RECORDING_MODE == True or self.paused == True: return
 		
-		while self.curBeat < len(self.beats) - 1 and time.time() - self.context['timeLevelStart'] >= self.beats[self.curBeat]:
+		curLevelTime = simTime - self.context['timeLevelStart']
+		while self.curBeat < len(self.beats) - 1 and curLevelTime >= self.beats[self.curBeat]:
 			self.lastBeatTime = self.beats[self.curBeat]
 			self.curBeat = self.curBeat + 1
+		self.simulateHolds(curLevelTime)
 		
-		# Spawn
-		self.spawnArrows()
-		self.updateScoreDigitSprites()
+	def handleUpdate(self):
+		if self.RECORDING_MODE == True: return
 		
-		# Update
-		for flash in self.hudArrowFlashers: flash.update()
-		for sprite in list(self.sprites): sprite.update()
-		for flasher in list(self.flashers): flasher.update()
-		for digit in self.scoreDigits: digit.update()
+		if self.paused == False:
+			# Spawn
+			self.spawnArrows()
+			for player in self.players:
+				self.updateScoreDigitSprites(player)
+				player.retireNotes()
+			
+			# Update
+			self.scene.update()
+			self.positionArrows()
+			self.sparks.update(time.time())
 		
 		# Draw
 		self.drawBG()
-		self.drawSprites()
-		self.drawHUD()
+		for rect in self.scene.draw(): self.trackRect(rect)
+		if self.paused == True:
+			surf = self.context['surfDisp']
+			self.trackRect(surf.blit(self.imgPaused, (
+				(surf.get_width() - self.imgPaused.get_width()) / 2,
+				self.context['scaler'].toScreen((0, self.PAUSED_TEXT_Y))[1])))
+		if self.context['dirtyRects'] == True and self.erasedRects != None:
+			self.context['updateRects'] = self.erasedRects + self.drawnRects
+		if self.paused == True: return
 		
-	def getKeyIndex(self, event):
-		if (event.type == KEYDOWN or event.type == KEYUP) and event.key in self.KEYS:
-			return self.KEYS.index(event.key)
-		return -1
+		curLevelTime = time.time() - self.context['timeLevelStart']
+		if self.context['practiceMode'] == True and curLevelTime >= self.nextSnapshotTime:
+			self.takeSnapshot(curLevelTime)
+			self.nextSnapshotTime = self.nextSnapshotTime + self.SNAPSHOT_INTERVAL
+		if self.isSongOver(curLevelTime): self.finish()
+		
+	def getKeyTarget(self, event):
+		"""
+			Returns (player, column) for a key or pad button
+			event that plays a note, or None.
+		"""
+		if event.type == KEYDOWN or event.type == KEYUP:
+			return self.keyMap.get(event.key)
+		if (event.type == JOYBUTTONDOWN or event.type == JOYBUTTONUP) and event.button in self.PAD_BUTTONS:
+			if event.instance_id in self.padMap:
+				return (self.padMap[event.instance_id], self.PAD_BUTTONS.index(event.button))
+		return None
+		
+	def isColumnDown(self, player, col):
+		"""
+			True if the player's key or pad button for the
+			column is down right now.
+		"""
+		if pygame.key.get_pressed()[player.keys[col]]: return True
+		for pad in self.pads:
+			if self.padMap[pad.get_instance_id()] == player and pad.get_button(self.PAD_BUTTONS[col]): return True
+		return False
+		
+	def getEventLevelTime(self, event):
+		return self.context['input'].getEventTime(event) - self.context['timeLevelStart']
+		
+	def flushRecordedNotes(self):
+		"""
+			Hands every leading note that has been released
+			to the chart writer, so the chart stays sorted by
+			down time while later presses are still held.
+		"""
+		while len(self.recordedNotes) > 0 and self.ARROW_TIMING_KEY_UP in self.recordedNotes[0]:
+			note = self.recordedNotes.popleft()
+			self.chartWriter.append(
+				note[self.ARROW_TIMING_KEY_DOWN], note[self.ARROW_TIMING_KEY_UP], note[self.ARROW_TIMING_KEY_KEY])
+			
+	def stopRecording(self, eventTime):
+		for note in self.openPresses:
+			if note != None: note[self.ARROW_TIMING_KEY_UP] = eventTime
+		self.openPresses = [None] * self.NUM_ARROW_DIRECTIONS
+		self.flushRecordedNotes()
+		self.chartWriter.commit()
+		self.chartWriter = None
+		
+	def handleShutdown(self):
+		if self.chartWriter != None: self.stopRecording(time.time() - self.context['timeLevelStart'])
 		
 	def recordKeys(self, event):
-		if self.RECORDING_MODE == False: return
+		if self.RECORDING_MODE == False or self.chartWriter == None: return
 		
-		if (event.type == KEYDOWN or event.type == KEYUP) and event.key == self.KEY_QUIT_RECORDING:
-			with open(self.ARROW_TIMING_FILE, 'w') as f:
-				for keystroke in self.keystrokes:
-					f.write('%f\t%f\t%f\n' % (
-						keystroke[self.ARROW_TIMING_KEY_DOWN], keystroke[self.ARROW_TIMING_KEY_UP], keystroke[self.ARROW_TIMING_KEY_KEY]))
+		if event.type == KEYDOWN and event.key == self.KEY_QUIT_RECORDING:	# Not the key-up of the key that started the song
+			self.stopRecording(self.getEventLevelTime(event))
 			return
 						
-		keyIndex = self.getKeyIndex(event)
-		if keyIndex >= 0:
-			eventTime = time.time() - self.context['timeLevelStart']
-			if event.type == KEYDOWN:
-				self.keystrokes.append(
-					{	
-						self.ARROW_TIMING_KEY_DOWN:eventTime,
-						self.ARROW_TIMING_KEY_KEY:keyIndex
-					})
-			elif event.type == KEYUP:
-				for keystroke in self.keystrokes:
-					if keystroke[self.ARROW_TIMING_KEY_KEY] == keyIndex and self.ARROW_TIMING_KEY_UP not in keystroke.keys():
-						keystroke[self.ARROW_TIMING_KEY_UP] = eventTime
+		target = self.getKeyTarget(event)
+		if target != None and target[0].index == 0:		# One player records
+			keyIndex = target[1]
+			eventTime = self.getEventLevelTime(event)
+			if (event.type == KEYDOWN or event.type == JOYBUTTONDOWN) and self.openPresses[keyIndex] == None:
+				note = {	
+					self.ARROW_TIMING_KEY_DOWN:eventTime,
+					self.ARROW_TIMING_KEY_KEY:keyIndex
+				}
+				self.openPresses[keyIndex] = note
+				self.recordedNotes.append(note)
+			elif (event.type == KEYUP or event.type == JOYBUTTONUP) and self.openPresses[keyIndex] != None:
+				self.openPresses[keyIndex][self.ARROW_TIMING_KEY_UP] = eventTime
+				self.openPresses[keyIndex] = None
+				self.flushRecordedNotes()
 			
 	def handleEvent(self, event):
 		self.recordKeys(event)
-		curLevelTime = time.time() - self.context['timeLevelStart']
-		keyIndex = self.getKeyIndex(event)
-		if event.type == KEYDOWN and keyIndex >= 0 and len(self.sprites) > 0:
-			arrowData = self.sprites[0].data
+		if self.RECORDING_MODE == False and event.type == KEYDOWN:
+			if event.key in self.KEYS_PAUSE:
+				if self.paused == True: self.resume()
+				else: self.pause()
+				return
+			if event.key in self.KEYS_REWIND and self.context['practiceMode'] == True:
+				self.rewind()
+				return
+		if self.paused == True: return
+		
+		target = self.getKeyTarget(event)
+		if target == None: return
+		player, keyIndex = target
+		curLevelTime = self.getEventLevelTime(event)
+		player.retireNotes()
+		if (event.type == KEYDOWN or event.type == JOYBUTTONDOWN) and len(player.sprites) > 0:
+			arrowData = player.sprites[0].data
 			hit = False
 			if arrowData[self.ARROW_TIMING_KEY_KEY] == keyIndex:
 				for i in range(len(self.HIT_THRESHOLDS)):
 					delta = arrowData[self.ARROW_TIMING_KEY_DOWN] - curLevelTime
 					if abs(delta) <= self.HIT_THRESHOLDS[i]:
 						hit = True
-						self.score = min(self.score + self.SCORE_VALUES[i], (10 ** self.NUM_SCORE_DIGITS) - 1)
+						self.addScore(player, self.SCORE_VALUES[i])
 						txtIdx = i
 						if i >= 2 and delta < 0: txtIdx = txtIdx + 1
-						self.sprites.pop(0)
-						self.spawnHitFlasher(keyIndex, txtIdx)
-						self.updateArrowTypes()
+						player.stats.addHit(i, -1 * delta)
+						sprite = player.sprites.popleft()
+						if self.isHoldNote(arrowData): self.startHold(player, sprite, keyIndex, curLevelTime)
+						else: player.laneGroups[keyIndex].retire(sprite)
+						self.spawnHitFlasher(player, keyIndex, txtIdx)
+						self.updateArrowTypes(player)
 						break
 			if hit == False:
-				self.spawnMissFlasher()
+				self.spawnMissFlasher(player)
 				pass
+		elif (event.type == KEYUP or event.type == JOYBUTTONUP) and player.activeHolds[keyIndex] != None:
+			self.releaseHold(player, keyIndex, curLevelTime)
 				
 		
+#----------------------------------------------------------
+# BPResultsController class
+#----------------------------------------------------------
+class BPResultsController(BPController):
+	"""
+		Shows how the last play went: score, judgement
+		counts, max combo, the mean and spread of the hit
+		offsets and their histogram, one column per player.
+		A single player's column sits next to the song's top
+		scores. Gameplay leaves the play in context['results']
+		(leaderboard rows) and context['stats'], one of each
+		per player. Practice plays aren't saved.
+		
+		The results are saved and the top scores looked up
+		on the leaderboard's worker thread. Everything else is
+		drawn from the first frame; the top scores fill in
+		when the lookup is done.
+	"""
+	results = []
+	stats = []
+	font = None
+	lineHeight = 0
+	imgLines = []
+	topScores = None
+	imgTopScores = None
+	
+	KEYS_CONTINUE = [K_RETURN, K_SPACE, K_ESCAPE]	# Back to song select
+	
+	TIER_NAMES = ('Perfect', 'Great', 'Good')	# One per hit threshold
+	NUM_TOP_SCORES = 5				# Leaderboard rows shown
+	STATS_POS = (60, 40)			# Top left of the play's stats (layout pixels)
+	TOP_SCORES_POS = (560, 40)		# Top left of the leaderboard
+	LINE_HEIGHT = 36
+	HISTOGRAM_RECT = (60, 380, 400, 120)	# Offset histogram area, early on the left
+	FONT_SIZE = 36
+	COLUMN_WIDTH = 300				# Width of each player's column (2+ players)
+	MULTI_LINE_HEIGHT = 30
+	MULTI_FONT_SIZE = 28
+	MULTI_HISTOGRAM_WIDTH = 260
+	TEXT_COLOR = (255, 255, 255)
+	HIGHLIGHT_COLOR = (255, 210, 60)	# This play on the leaderboard
+	BAR_COLOR = (90, 170, 255)
+	BG_COLOR = (0, 0, 0)
+	
+	def __init__(self, parent, context):
+		BPController.__init__(self, parent, context)
+		self.results = []
+		self.stats = []
+		self.font = None
+		self.lineHeight = 0
+		self.imgLines = []
+		self.topScores = None
+		self.imgTopScores = None
+		
+	def start(self):
+		self.results = self.context['results']
+		self.stats = self.context['stats']
+		leaderboard = self.context['leaderboard']
+		if self.context['practiceMode'] == False:
+			for result in self.results: leaderboard.addResult(result)
+		if len(self.results) == 1:
+			self.topScores = leaderboard.getTopScores(self.results[0][BPLeaderboard.RESULT_KEY_HASH], self.NUM_TOP_SCORES)
+			
+		fontSize = self.FONT_SIZE
+		self.lineHeight = self.LINE_HEIGHT
+		if len(self.results) > 1:
+			fontSize = self.MULTI_FONT_SIZE
+			self.lineHeight = self.MULTI_LINE_HEIGHT
+		self.font = pygame.font.Font(None, self.context['scaler'].toScreenLength(fontSize))
+		self.imgLines = []
+		for result, stats in zip(self.results, self.stats):
+			lines = []
+			if len(self.results) > 1: lines.append(result[BPLeaderboard.RESULT_KEY_PLAYER])
+			lines.append('Score  %d' % result[BPLeaderboard.RESULT_KEY_SCORE])
+			for i in range(len(self.TIER_NAMES)):
+				lines.append('%s  %d' % (self.TIER_NAMES[i], stats.tierCounts[i]))
+			lines.append('Miss  %d' % stats.misses)
+			lines.append('Dropped  %d' % stats.drops)
+			lines.append('Max combo  %d' % stats.maxCombo)
+			lines.append('Offset  %+.1f ms (+/- %.1f)' % (1000.0 * stats.meanOffset, 1000.0 * stats.getStdDev()))
+			self.imgLines.append([self.font.render(line, True, self.TEXT_COLOR) for line in lines])
+		
+	def getTopScoreLines(self):
+		"""
+			Rendered leaderboard rows, or None until the
+			lookup is done (or with more than one player).
+		"""
+		if self.topScores == None: return None
+		if self.imgTopScores == None and self.topScores.done():
+			result = self.results[0]
+			self.imgTopScores = [self.font.render('Top scores', True, self.TEXT_COLOR)]
+			for i, row in enumerate(self.topScores.result()):
+				color = self.TEXT_COLOR
+				if row[BPLeaderboard.RESULT_KEY_PLAYED] == result[BPLeaderboard.RESULT_KEY_PLAYED] and \
+					row[BPLeaderboard.RESULT_KEY_PLAYER] == result[BPLeaderboard.RESULT_KEY_PLAYER]:
+					color = self.HIGHLIGHT_COLOR
+				text = '%d. %s  %d' % (i + 1, row[BPLeaderboard.RESULT_KEY_PLAYER], row[BPLeaderboard.RESULT_KEY_SCORE])
+				self.imgTopScores.append(self.font.render(text, True, color))
+		return self.imgTopScores
+		
+	def drawHistogram(self, surf, scaler, stats, x):
+		y, width, height = self.HISTOGRAM_RECT[1:]
+		if len(self.results) > 1: width = self.MULTI_HISTOGRAM_WIDTH
+		histogram = stats.histogram
+		tallest = max(histogram + [1])
+		barWidth = float(width) / len(histogram)
+		for i in range(len(histogram)):
+			if histogram[i] == 0: continue
+			barHeight = float(height) * histogram[i] / tallest
+			left, top = scaler.toScreen((x + (i * barWidth), y + height - barHeight))
+			right, bottom = scaler.toScreen((x + ((i + 1) * barWidth), y + height))
+			pygame.draw.rect(surf, self.BAR_COLOR, (left, top, max(right - left - 1, 1), bottom - top))
+		centerX = scaler.toScreen((x + (width / 2.0), 0))[0]
+		pygame.draw.line(surf, self.TEXT_COLOR, (centerX, scaler.toScreen((0, y))[1]), (centerX, scaler.toScreen((0, y + height))[1]))
+		
+	def handleUpdate(self):
+		surf = self.context['surfDisp']
+		scaler = self.context['scaler']
+		surf.fill(self.BG_COLOR)
+		for column in range(len(self.imgLines)):
+			x = self.STATS_POS[0] + (column * self.COLUMN_WIDTH)
+			lines = self.imgLines[column]
+			for i in range(len(lines)):
+				surf.blit(lines[i], scaler.toScreen((x, self.STATS_POS[1] + (i * self.lineHeight))))
+			self.drawHistogram(surf, scaler, self.stats[column], self.HISTOGRAM_RECT[0] + (column * self.COLUMN_WIDTH))
+		
+		lines = self.getTopScoreLines()
+		if lines != None:
+			for i in range(len(lines)):
+				surf.blit(lines[i], scaler.toScreen((self.TOP_SCORES_POS[0], self.TOP_SCORES_POS[1] + (i * self.LINE_HEIGHT))))
+				
+	def handleEvent(self, event):
+		if event.type == KEYDOWN and event.key in self.KEYS_CONTINUE:
+			self.exit()
+			
 #----------------------------------------------------------
 # BPGame class
 #----------------------------------------------------------
@@ -742,19 +3796,63 @@ class BPGame(BPController):
 		is stored in the context attribute.
 	"""
 	rootController = None	
+	simTime = 0.0
+	
+	SIM_RATE = 1000				# Input sampling and simulation steps per second
+	MAX_SIM_STEPS = 100			# Steps run at most per poll, after a stall the rest are skipped
 	
 	# CONTROLLER STATES
 	BPSTATE_START		= "start"
+	BPSTATE_SONG_SELECT	= "song_select"
 	BPSTATE_GAMEPLAY 	= "gameplay"
+	BPSTATE_RESULTS		= "results"
 	
 	def __init__(self, context):
 		BPController.__init__(self, None, context)
 		self.rootController = self
+		self.simTime = 0.0
+		
+	def handleShutdown(self):
+		self.context['leaderboard'].stop()		# Write the queued results
 		
 	def handleChildExit(self):
 		if self.state == self.BPSTATE_START:
+			self.changeState(self.BPSTATE_SONG_SELECT)
+			self.launchChild(BPSongSelectController(self, self.context))
+		elif self.state == self.BPSTATE_SONG_SELECT:
 			self.changeState(self.BPSTATE_GAMEPLAY)
 			self.launchChild(BPGameplayController(self, self.context))
+		elif self.state == self.BPSTATE_GAMEPLAY:
+			self.changeState(self.BPSTATE_RESULTS)
+			self.launchChild(BPResultsController(self, self.context))
+		elif self.state == self.BPSTATE_RESULTS:
+			self.changeState(self.BPSTATE_SONG_SELECT)
+			self.launchChild(BPSongSelectController(self, self.context))
+		
+	def poll(self):
+		"""
+			Samples input and catches the fixed-rate simulation
+			up to now. Called between frames at about SIM_RATE,
+			so events are handled (and judged) within a step of
+			arriving rather than once per frame.
+		"""
+		now = time.time()
+		
+		# Pass the input events up the controller stack
+		for event in self.context['input'].capture():
+			if event.type == QUIT:
+				self.rootController.onShutdown()
+				pygame.quit()
+				sys.exit()
+			else:
+				self.rootController.onEvent(event)
+				
+		step = 1.0 / float(self.SIM_RATE)
+		if now - self.simTime > step * self.MAX_SIM_STEPS:
+			self.simTime = now - step
+		while self.simTime + step <= now:
+			self.simTime = self.simTime + step
+			self.rootController.onSimulate(self.simTime)
 		
 	def run(self):
 		self.changeState(self.BPSTATE_START)
@@ -762,18 +3860,16 @@ class BPGame(BPController):
 		
 		# MAIN GAME LOOP
 		while True: 
-			# Pass the input events up the controller stack
-			for event in pygame.event.get():
-				if event.type == QUIT:
-					pygame.quit()
-					sys.exit()
-				else:
-					self.rootController.onEvent(event)
+			self.context['updateRects'] = None
+			self.poll()
 
+			# Render at the display rate
 			self.rootController.onUpdate()
-			pygame.display.update()
+			self.context['display'].present(self.context['updateRects'])	# None updates the whole window
+			self.context['presentLatency'] = self.context['display'].presentLatency
 			
-			self.context['clockFPS'].tick(self.context['FPS'])
+			# Sample input and simulate until the next frame is due
+			self.context['display'].waitForNextFrame(self.poll)
 
 #----------------------------------------------------------
 # main() function
@@ -784,13 +3880,35 @@ def main():
 	bpContext = {}
 	bpContext['pygame'] = pygame
 	bpContext['FPS'] = 60 
-	bpContext['windowSize'] = (960, 540)
+	bpContext['windowSize'] = (960, 540)		# Output resolution, any size works
+	bpContext['layoutSize'] = BPScaler.LAYOUT_SIZE
+	bpContext['assetCacheDir'] = '.scaled'		# Scaled image cache
 	bpContext['title'] = 'K-Pop Star!'
 	bpContext['musicEnabled'] = True
+	bpContext['dirtyRects'] = False		# Only redraw and update the areas that changed
+	bpContext['songsDir'] = '.'
+	bpContext['scrollSpeed'] = 1.0		# Arrow scroll speed multiplier, changed on song select
+	bpContext['practiceMode'] = False	# Rewind in gameplay, toggled on song select
 	
-	bpContext['clockFPS'] = pygame.time.Clock()
-	bpContext['surfDisp'] = pygame.display.set_mode((bpContext['windowSize'][0], bpContext['windowSize'][1]))
+	bpContext['vsync'] = False		# Keep the limiter so input is polled between frames
+	bpContext['presentLatency'] = 0.0
+	bpContext['input'] = BPInputCapture()
+	bpContext['calibrationFile'] = os.path.join(os.path.expanduser('~'), '.bubblepop_offset')
+	bpContext['globalOffset'] = 0.0
+	if os.path.exists(bpContext['calibrationFile']):
+		with open(bpContext['calibrationFile'], 'r') as f:
+			bpContext['globalOffset'] = float(f.read())
+	bpContext['display'] = BPDisplay(bpContext['windowSize'], bpContext['FPS'], bpContext['vsync'])
+	bpContext['surfDisp'] = bpContext['display'].open()
+	bpContext['scaler'] = BPScaler(bpContext['windowSize'], bpContext['assetCacheDir'])
 	#bpContext['fontTitle'] = pygame.font.Font('freesansbold.ttf', 18)
+	
+	bpContext['library'] = BPSongLibrary(bpContext['songsDir'])
+	bpContext['library'].load()
+	bpContext['playerNames'] = ['Player 1', 'Player 2', 'Player 3']	# One per BPGameplayController.PLAYER_KEYS
+	bpContext['numPlayers'] = 1			# Players on the same machine, changed on song select
+	bpContext['leaderboard'] = BPLeaderboard(os.path.join(os.path.expanduser('~'), '.bubblepop_scores.db'))
+	bpContext['leaderboard'].start()
 
 	pygame.display.set_caption(bpContext['title'])
 	bpGame = BPGame(bpContext)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+import os, argparse, bisect, random, concurrent.futures
+
+"""
+	Auto charter for BubblePop
+
+	Drafts charts for songs from their audio onsets (see
+	BPAudioAnalyzer in beatTool.py) and their beats_N.txt.
+	One draft is written per density, as timing_N.<name>.txt
+	next to the song; rename the one you want to
+	timing_N.txt after playing it through.
+
+	python autoCharter.py [songsDir] [--level N ...] [--jobs N] [--force]
+
+	Levels run in a process pool, one song per worker at a
+	time. Needs NumPy.
+"""
+
+from beatTool import BPAudioAnalyzer
+from BubblePop import BPSongLibrary, BPCompiledChart
+
+#----------------------------------------------------------
+# BPAutoCharter class
+#----------------------------------------------------------
+class BPAutoCharter(object):
+	"""
+		Turns onsets into notes. For each density the beat
+		grid is split into that many steps per beat, each
+		onset snaps to its nearest step, and a step keeps its
+		strongest onset if that is at least the density's
+		share of the song's strongest onsets.
+
+		Columns follow the onset's spectral centroid, lower
+		sounds to the left, with two rules on top:
+
+		- no jacks: a note never repeats the previous column
+		- no overlaps: a column is free only once its last
+		  note is released
+	"""
+	beats = []
+	onsets = []
+	seed = 0
+
+	# (name, steps per beat, fraction of the onsets kept)
+	DENSITIES = (
+		('easy', 1, 0.35),
+		('normal', 2, 0.6),
+		('hard', 4, 1.0))
+	NUM_COLUMNS = BPCompiledChart.NUM_COLUMNS
+	TAP_TIME = 0.08					# Up time after each note (seconds)
+	DRAFT_FILE = 'timing_%d.%s.txt'
+
+	def __init__(self, beats, onsets, seed = 0):
+		self.beats = beats
+		self.onsets = onsets
+		self.seed = seed
+
+	def snap(self, t, steps):
+		"""
+			Returns the grid step nearest t as (beat index,
+			step), or None outside the beat grid.
+		"""
+		i = bisect.bisect_right(self.beats, t) - 1
+		if i < 0 or i >= len(self.beats) - 1: return None
+		step = int(round(steps * (t - self.beats[i]) / (self.beats[i + 1] - self.beats[i])))
+		if step == steps: return (i + 1, 0)
+		return (i, step)
+
+	def getStepTime(self, beat, step, steps):
+		if step == 0: return self.beats[beat]
+		return self.beats[beat] + ((self.beats[beat + 1] - self.beats[beat]) * step / float(steps))
+
+	def getColumns(self):
+		"""
+			Centroid limits between the columns, as quartiles
+			of the onsets' centroids.
+		"""
+		centroids = sorted([onset[2] for onset in self.onsets])
+		if len(centroids) == 0: return []
+		return [centroids[(len(centroids) * i) // self.NUM_COLUMNS] for i in range(1, self.NUM_COLUMNS)]
+
+	def chart(self, steps, keep):
+		strengths = sorted([onset[1] for onset in self.onsets], reverse = True)
+		if len(strengths) == 0: return []
+		threshold = strengths[min(max(int(len(strengths) * keep), 1), len(strengths)) - 1]
+
+		# Strongest onset per grid step
+		grid = {}
+		for t, strength, centroid in self.onsets:
+			if strength < threshold: continue
+			key = self.snap(t, steps)
+			if key != None and (key not in grid or grid[key][0] < strength):
+				grid[key] = (strength, centroid)
+
+		limits = self.getColumns()
+		rng = random.Random(self.seed)
+		released = [float('-inf')] * self.NUM_COLUMNS
+		previous = None
+		notes = []
+		for key in sorted(grid.keys()):
+			down = self.getStepTime(key[0], key[1], steps)
+			up = down + self.TAP_TIME
+			preferred = bisect.bisect_right(limits, grid[key][1])
+			free = [col for col in range(self.NUM_COLUMNS) if col != previous and released[col] <= down]
+			if len(free) == 0: continue
+			col = min(free, key = lambda col: (abs(col - preferred), rng.random()))
+			notes.append((down, up, col))
+			released[col] = up
+			previous = col
+		return notes
+
+	def writeDraft(self, path, notes):
+		with open(path, 'w') as f:
+			f.write(''.join(['%f\t%f\t%d\n' % note for note in notes]))
+
+def chartLevel(songsDir, level, force):
+	"""
+		Drafts every density for a level. Runs in a worker
+		process; returns (level, [(path, note count or None)]).
+	"""
+	analyzer = BPAudioAnalyzer()
+	analyzer.load(os.path.join(songsDir, BPSongLibrary.SONG_FILE % level))
+	with open(os.path.join(songsDir, BPSongLibrary.BEAT_FILE % level), 'r') as f:
+		beats = sorted(set([float(line.split('\t')[0]) for line in f if line.strip() != '']))
+	charter = BPAutoCharter(beats, analyzer.getOnsets(), level)
+
+	results = []
+	for name, steps, keep in charter.DENSITIES:
+		path = os.path.join(songsDir, charter.DRAFT_FILE % (level, name))
+		if os.path.exists(path) and force == False:
+			results.append((path, None))
+			continue
+		notes = charter.chart(steps, keep)
+		charter.writeDraft(path, notes)
+		results.append((path, len(notes)))
+	return (level, results)
+
+def findLevels(songsDir):
+	levels = []
+	for name in os.listdir(songsDir):
+		match = BPSongLibrary.BEAT_FILE_PATTERN.match(name)
+		if match != None and os.path.exists(os.path.join(songsDir, BPSongLibrary.SONG_FILE % int(match.group(1)))):
+			levels.append(int(match.group(1)))
+	return sorted(levels)
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Draft BubblePop charts from song audio.')
+	parser.add_argument('songsDir', nargs = '?', default = '.')
+	parser.add_argument('--level', type = int, action = 'append', help = 'only this level (repeatable)')
+	parser.add_argument('--jobs', type = int, default = None, help = 'worker processes (default: one per CPU)')
+	parser.add_argument('--force', action = 'store_true', help = 'overwrite existing drafts')
+	args = parser.parse_args()
+
+	levels = args.level if args.level != None else findLevels(args.songsDir)
+	with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+		results = [pool.submit(chartLevel, args.songsDir, level, args.force) for level in levels]
+		for result in results:
+			level, drafts = result.result()
+			for path, count in drafts:
+				if count == None: print('level %d: %s exists, use --force to replace it' % (level, path))
+				else: print('level %d: %s, %d notes' % (level, path, count))
+
+#----------------------------------------------------------
+# Call main()
+#----------------------------------------------------------
+if __name__ == '__main__':
+	main()
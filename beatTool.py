@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+import sys, os, argparse
+import numpy
+
+"""
+	Beat tool for BubblePop
+
+	Writes beats_N.txt for a song from its song_N.ogg, in
+	place of tapping along in a recording session.
+
+	python beatTool.py [songsDir] --level N [--level N ...] [--force]
+
+	Needs NumPy. The game itself doesn't.
+"""
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')		# Decoding only, nothing is played
+import pygame
+from BubblePop import BPSongLibrary
+
+#----------------------------------------------------------
+# BPAudioAnalyzer class
+#----------------------------------------------------------
+class BPAudioAnalyzer(object):
+	"""
+		Onset and beat analysis of a song.
+
+		The decoded samples are read in place (through
+		pygame.sndarray) and the STFT is taken CHUNK_FRAMES
+		frames at a time, so working memory doesn't grow
+		with the length of the song. Each chunk yields its
+		part of the onset envelope: the positive spectral
+		flux of the log magnitude spectrum, one value per
+		HOP_SIZE samples.
+
+		Tempo is the autocorrelation peak of the envelope,
+		weighted towards TEMPO_PRIOR_BPM. Beats are then
+		tracked with dynamic programming: each frame's score
+		is its onset strength plus the best earlier score
+		about one beat back, penalized by how far the gap is
+		from the beat period.
+
+		Alongside the envelope, each frame's spectral
+		centroid (Hz) is kept as a rough pitch for onsets.
+	"""
+	sampleRate = 0
+	envelope = None
+	centroids = None
+	frameRate = 0.0
+
+	FRAME_SIZE = 2048				# STFT window (samples)
+	HOP_SIZE = 512					# Samples between envelope values
+	CHUNK_FRAMES = 1024				# STFT frames per chunk
+	LOG_COMPRESSION = 1000.0		# Magnitude compression before the flux
+	MEAN_WINDOW = 0.5				# Seconds of local mean removed from the envelope
+	MIN_BPM = 60.0
+	MAX_BPM = 200.0
+	TEMPO_PRIOR_BPM = 120.0			# Tempo the estimate leans towards
+	TEMPO_PRIOR_WIDTH = 1.0			# Width of the prior in octaves
+	TIGHTNESS = 100.0				# How strictly beats keep to the period
+	ONSET_WINDOW = 0.05				# Seconds either side an onset must be the peak of
+	ONSET_THRESHOLD = 0.5			# Smallest onset strength (envelope standard deviations)
+	BEAT_UP_TIME = 0.1				# Up time written after each beat, as if tapped
+	BEAT_KEY = 0					# Key column written for each beat, as in a recorded beats_N.txt
+
+	def __init__(self):
+		self.sampleRate = 0
+		self.envelope = None
+		self.centroids = None
+		self.frameRate = 0.0
+
+	def load(self, path):
+		"""
+			Decodes the song and computes its onset envelope.
+		"""
+		if pygame.mixer.get_init() == None: pygame.mixer.init()
+		self.sampleRate = pygame.mixer.get_init()[0]
+		self.frameRate = float(self.sampleRate) / float(self.HOP_SIZE)
+		samples = pygame.sndarray.samples(pygame.mixer.Sound(path))
+		self.envelope, self.centroids = self.getOnsetEnvelope(samples)
+		return self.envelope
+
+	def getOnsetEnvelope(self, samples):
+		numFrames = max((len(samples) - self.FRAME_SIZE) // self.HOP_SIZE + 1, 0)
+		window = numpy.hanning(self.FRAME_SIZE).astype(numpy.float32)
+		scale = 1.0 / float(numpy.iinfo(samples.dtype).max) if samples.dtype.kind == 'i' else 1.0
+		freqs = numpy.fft.rfftfreq(self.FRAME_SIZE, 1.0 / self.sampleRate).astype(numpy.float32)
+		flux = numpy.zeros(numFrames, numpy.float32)
+		centroids = numpy.zeros(numFrames, numpy.float32)
+		previous = None
+		for first in range(0, numFrames, self.CHUNK_FRAMES):
+			count = min(self.CHUNK_FRAMES, numFrames - first)
+			start = first * self.HOP_SIZE
+			chunk = samples[start:start + ((count - 1) * self.HOP_SIZE) + self.FRAME_SIZE]
+			if chunk.ndim > 1: chunk = chunk.mean(axis = 1, dtype = numpy.float32)
+			chunk = chunk.astype(numpy.float32) * scale
+
+			frames = numpy.lib.stride_tricks.sliding_window_view(chunk, self.FRAME_SIZE)[::self.HOP_SIZE]
+			spectrum = numpy.log1p(self.LOG_COMPRESSION * numpy.abs(numpy.fft.rfft(frames * window, axis = 1)))
+			if previous is None: previous = spectrum[:1]
+			diff = numpy.diff(numpy.concatenate((previous, spectrum)), axis = 0)
+			flux[first:first + count] = numpy.maximum(diff, 0).sum(axis = 1)
+			centroids[first:first + count] = (spectrum @ freqs) / numpy.maximum(spectrum.sum(axis = 1), 1e-9)
+			previous = spectrum[-1:]
+
+		# Remove the local mean so only the peaks are left
+		width = max(int(self.MEAN_WINDOW * self.frameRate), 1)
+		localMean = numpy.convolve(flux, numpy.ones(width, numpy.float32) / width, 'same')
+		envelope = numpy.maximum(flux - localMean, 0)
+		deviation = envelope.std()
+		if deviation > 0: envelope = envelope / deviation
+		return envelope, centroids
+
+	def getOnsets(self, envelope = None):
+		"""
+			Returns (time, strength, centroid) for each peak of
+			the envelope that is the largest within ONSET_WINDOW
+			and at least ONSET_THRESHOLD strong.
+		"""
+		if envelope is None: envelope = self.envelope
+		width = max(int(self.ONSET_WINDOW * self.frameRate), 1)
+		padded = numpy.pad(envelope, width, mode = 'constant')
+		localMax = numpy.lib.stride_tricks.sliding_window_view(padded, (2 * width) + 1).max(axis = 1)
+		frames = numpy.nonzero((envelope >= localMax) & (envelope >= self.ONSET_THRESHOLD))[0]
+		times = (frames * self.HOP_SIZE + (self.FRAME_SIZE / 2)) / float(self.sampleRate)
+		return list(zip(times.tolist(), envelope[frames].tolist(), self.centroids[frames].tolist()))
+
+	def estimateTempo(self, envelope = None):
+		"""
+			Returns the beat period in envelope frames.
+		"""
+		if envelope is None: envelope = self.envelope
+		minLag = int(self.frameRate * 60.0 / self.MAX_BPM)
+		maxLag = int(self.frameRate * 60.0 / self.MIN_BPM) + 1
+		size = 1 << int(numpy.ceil(numpy.log2(len(envelope) + maxLag)))
+		spectrum = numpy.fft.rfft(envelope, size)
+		correlation = numpy.fft.irfft(spectrum * numpy.conj(spectrum), size)[:maxLag + 1]
+
+		lags = numpy.arange(minLag, maxLag + 1)
+		bpms = 60.0 * self.frameRate / lags
+		prior = numpy.exp(-0.5 * (numpy.log2(bpms / self.TEMPO_PRIOR_BPM) / self.TEMPO_PRIOR_WIDTH) ** 2)
+		best = lags[numpy.argmax(correlation[minLag:maxLag + 1] * prior)]
+
+		# Refine between neighbouring lags with a parabola through the peak
+		if minLag < best < maxLag:
+			a, b, c = correlation[best - 1], correlation[best], correlation[best + 1]
+			if a - (2 * b) + c != 0:
+				return best + (0.5 * (a - c) / (a - (2 * b) + c))
+		return float(best)
+
+	def trackBeats(self, period = None, envelope = None):
+		"""
+			Returns the beat times in seconds.
+		"""
+		if envelope is None: envelope = self.envelope
+		if period is None: period = self.estimateTempo(envelope)
+		if len(envelope) == 0: return []
+
+		# Candidate predecessors lie between half and two periods back
+		offsets = numpy.arange(-int(round(2 * period)), -int(round(period / 2)) + 1)
+		penalty = -self.TIGHTNESS * (numpy.log(-offsets / period) ** 2)
+		scores = envelope.astype(numpy.float64).copy()
+		backlink = numpy.full(len(envelope), -1)
+		for t in range(-offsets[-1], len(envelope)):
+			candidates = t + offsets
+			valid = candidates >= 0
+			weighted = scores[candidates[valid]] + penalty[valid]
+			best = numpy.argmax(weighted)
+			if weighted[best] > 0:
+				scores[t] = scores[t] + weighted[best]
+				backlink[t] = candidates[valid][best]
+
+		# Backtrack from the best score in the last period
+		tail = max(len(scores) - int(round(period)), 0)
+		frame = tail + int(numpy.argmax(scores[tail:]))
+		beats = []
+		while frame >= 0:
+			beats.append(frame)
+			frame = backlink[frame]
+		beats.reverse()
+		return [(frame * self.HOP_SIZE + (self.FRAME_SIZE / 2)) / float(self.sampleRate) for frame in beats]
+
+	def writeBeats(self, path, beats):
+		with open(path, 'w') as f:
+			f.write(''.join(['%f\t%f\t%d\n' % (beat, beat + self.BEAT_UP_TIME, self.BEAT_KEY) for beat in beats]))
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Detect the beats of BubblePop songs.')
+	parser.add_argument('songsDir', nargs = '?', default = '.')
+	parser.add_argument('--level', type = int, action = 'append', required = True, help = 'level to analyze (repeatable)')
+	parser.add_argument('--force', action = 'store_true', help = 'overwrite existing beat files')
+	args = parser.parse_args()
+
+	analyzer = BPAudioAnalyzer()
+	for level in args.level:
+		songPath = os.path.join(args.songsDir, BPSongLibrary.SONG_FILE % level)
+		beatPath = os.path.join(args.songsDir, BPSongLibrary.BEAT_FILE % level)
+		if os.path.exists(beatPath) and args.force == False:
+			print('level %d: %s exists, use --force to replace it' % (level, beatPath))
+			continue
+		analyzer.load(songPath)
+		period = analyzer.estimateTempo()
+		beats = analyzer.trackBeats(period)
+		analyzer.writeBeats(beatPath, beats)
+		print('level %d: %.1f BPM, %d beats' % (level, 60.0 * analyzer.frameRate / period, len(beats)))
+
+#----------------------------------------------------------
+# Call main()
+#----------------------------------------------------------
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import sys, os, argparse, concurrent.futures
+
+"""
+	Chart tool for BubblePop
+
+	Checks and compiles the timing_N.txt and beats_N.txt
+	files of a songs directory (see BPChartCompiler).
+	Levels are handled in parallel, one process each, and
+	levels whose sources haven't changed are skipped.
+
+	python chartTool.py [songsDir] [--level N ...] [--normalize] [--force] [--jobs N]
+
+	Exits with status 1 if any chart has errors.
+"""
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+from BubblePop import BPSongLibrary, BPChartCompiler, BPGameplayController, BPScaler
+
+def getCompiler(songsDir):
+	"""
+		A compiler set up with the note field gameplay
+		uses at 1x speed in the default layout.
+	"""
+	field = BPGameplayController(None, {'layoutSize':BPScaler.LAYOUT_SIZE})
+	return BPChartCompiler(songsDir, field.getPixelsPerSecond(), field.getSpawnDistance())
+
+def processLevel(songsDir, level, normalize, force):
+	compiler = getCompiler(songsDir)
+	if normalize == True: compiler.writeNormalized(level)
+	return (level,) + compiler.compile(level, force)
+
+def findLevels(songsDir):
+	levels = []
+	for name in os.listdir(songsDir):
+		match = BPSongLibrary.BEAT_FILE_PATTERN.match(name)
+		if match != None: levels.append(int(match.group(1)))
+	return sorted(levels)
+
+def main():
+	parser = argparse.ArgumentParser(description = 'Check and compile BubblePop charts.')
+	parser.add_argument('songsDir', nargs = '?', default = '.')
+	parser.add_argument('--level', type = int, action = 'append', help = 'only this level (repeatable)')
+	parser.add_argument('--normalize', action = 'store_true', help = 'rewrite the sources sorted and without duplicates')
+	parser.add_argument('--force', action = 'store_true', help = 'compile even if the sources are unchanged')
+	parser.add_argument('--jobs', type = int, default = None, help = 'worker processes (default: one per CPU)')
+	args = parser.parse_args()
+
+	levels = args.level if args.level != None else findLevels(args.songsDir)
+	failed = 0
+	with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+		results = [pool.submit(processLevel, args.songsDir, level, args.normalize, args.force) for level in levels]
+		for result in results:
+			level, status, errors, warnings = result.result()
+			print('level %d: %s' % (level, status))
+			for warning in warnings: print('  warning: %s' % warning)
+			for error in errors: print('  error: %s' % error)
+			if status == BPChartCompiler.STATUS_INVALID: failed = failed + 1
+
+	if failed > 0:
+		print('%d of %d charts have errors' % (failed, len(levels)))
+		sys.exit(1)
+
+#----------------------------------------------------------
+# Call main()
+#----------------------------------------------------------
+if __name__ == '__main__':
+	main()